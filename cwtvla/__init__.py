@@ -1,4 +1,5 @@
 #from . import ktp
-from .ktp import verify_AES, FixedVRandomKey, FixedVRandomText, SemiFixedVRandomText
+from .ktp import verify_AES, verify_AES_blocks, BulkVerifier, FixedVRandomKey, FixedVRandomText, SemiFixedVRandomText
 from .analysis import *
+from .trace_store import TraceStore, ZarrTraceStore, HDF5TraceStore, MemmapTraceStore, open_trace_store, trace_name
 #from . import tvla_cw
@@ -6,6 +6,10 @@ Performs single block cipher decipher operations on a 16 element list of integer
 These integers represent 8 bit bytes in a 128 bit block.
 The result of cipher or decipher operations is the transformed 16 element list of integers.
 
+cipher_blocks and decipher_blocks do the same for many blocks at once, taking and returning
+(N, 16) numpy uint8 arrays. TTableAESCipher is a faster drop-in for single blocks, and
+BatchKeyAESCipher encrypts blocks that each have their own key.
+
 Running this file as __main__ will result in a self-test of the algorithm.
 
 Algorithm per NIST FIPS-197 http://csrc.nist.gov/publications/fips/fips197/fips-197.pdf
@@ -19,6 +23,91 @@ Licensed under the MIT license http://www.opensource.org/licenses/mit-license.ph
 __author__ = "Adam Newman"
 
 from . import aes_tables
+import numpy as np
+import struct
+
+#Lookup tables for operating on (N, 16) arrays of blocks
+_np_sbox = np.array(aes_tables.sbox, dtype=np.uint8)
+_np_i_sbox = np.array(aes_tables.i_sbox, dtype=np.uint8)
+_np_galNI = np.array(aes_tables.galNI, dtype=np.uint8)
+_np_galI = np.array(aes_tables.galI, dtype=np.uint8)
+
+#state[j] comes from state[_shift_rows_idx[j]] after shift rows (column major state)
+_shift_rows_idx = np.array([4*((j//4 + j%4) % 4) + j%4 for j in range(16)])
+_i_shift_rows_idx = np.array([4*((j//4 - j%4) % 4) + j%4 for j in range(16)])
+
+def _t_table(gal, box, row):
+    #Column (as a big endian word) that a byte in the given row contributes after sub bytes and mix columns
+    g = [gal[(row - k) % 4] for k in range(4)]
+    return [(g[0][s] << 24) | (g[1][s] << 16) | (g[2][s] << 8) | g[3][s] for s in box]
+
+#Encryption and decryption T-tables, one per state row
+_Te = [_t_table(aes_tables.galNI, aes_tables.sbox, r) for r in range(4)]
+_Td = [_t_table(aes_tables.galI, aes_tables.i_sbox, r) for r in range(4)]
+_Tmix_i = [_t_table(aes_tables.galI, range(256), r) for r in range(4)]
+
+#The *_blocks functions below work in place on (N, 16) uint8 arrays of states.
+#round_keys is (Nr+1, 16) for a single key, or (Nr+1, N, 16) for a key per state
+
+def _sub_bytes_blocks(states):
+    states[:] = _np_sbox[states]
+
+def _i_sub_bytes_blocks(states):
+    states[:] = _np_i_sbox[states]
+
+def _shift_rows_blocks(states):
+    states[:] = states[:, _shift_rows_idx]
+
+def _i_shift_rows_blocks(states):
+    states[:] = states[:, _i_shift_rows_idx]
+
+def _mix_columns_blocks(states, inverse):
+    g0,g1,g2,g3=_np_galI if inverse else _np_galNI
+    cols = states.reshape(-1, 4, 4)
+    c0,c1,c2,c3 = cols[:,:,0].copy(),cols[:,:,1].copy(),cols[:,:,2].copy(),cols[:,:,3].copy()
+    cols[:,:,0] = g0[c0]^g1[c1]^g2[c2]^g3[c3]
+    cols[:,:,1] = g3[c0]^g0[c1]^g1[c2]^g2[c3]
+    cols[:,:,2] = g2[c0]^g3[c1]^g0[c2]^g1[c3]
+    cols[:,:,3] = g1[c0]^g2[c1]^g3[c2]^g0[c3]
+
+def _add_round_key_blocks(states, round_keys, round):
+    states ^= round_keys[round]
+
+def _cipher_blocks(states, round_keys):
+    #Encrypt a copy of states, returned as a new (N, 16) array
+    states = np.array(states, dtype=np.uint8, order='C').reshape(-1, 16)
+    nr = len(round_keys) - 1
+
+    _add_round_key_blocks(states, round_keys, 0)
+
+    for i in range(1, nr):
+        _sub_bytes_blocks(states)
+        _shift_rows_blocks(states)
+        _mix_columns_blocks(states, False)
+        _add_round_key_blocks(states, round_keys, i)
+
+    _sub_bytes_blocks(states)
+    _shift_rows_blocks(states)
+    _add_round_key_blocks(states, round_keys, nr)
+    return states
+
+def _decipher_blocks(states, round_keys):
+    #Decrypt a copy of states, returned as a new (N, 16) array
+    states = np.array(states, dtype=np.uint8, order='C').reshape(-1, 16)
+    nr = len(round_keys) - 1
+
+    _add_round_key_blocks(states, round_keys, nr)
+
+    for i in range(nr - 1, 0, -1):
+        _i_shift_rows_blocks(states)
+        _i_sub_bytes_blocks(states)
+        _add_round_key_blocks(states, round_keys, i)
+        _mix_columns_blocks(states, True)
+
+    _i_shift_rows_blocks(states)
+    _i_sub_bytes_blocks(states)
+    _add_round_key_blocks(states, round_keys, 0)
+    return states
 
 class AESCipher:
     """Perform single block AES cipher/decipher"""
@@ -30,6 +119,9 @@ class AESCipher:
         #Number of rounds determined by expanded key length
         self._Nr = int(len(expanded_key) / 16) - 1
 
+        #Round keys as a (Nr+1, 16) array for the *_blocks methods
+        self._np_round_keys = np.array(expanded_key, dtype=np.uint8).reshape(-1, 16)
+
     def _sub_bytes (self, state):
         #Run state through sbox
         for i,s in enumerate(state):state[i]=aes_tables.sbox[s]
@@ -117,3 +209,151 @@ class AESCipher:
         self._i_sub_bytes(state)
         self._add_round_key(state, 0)
         return state
+
+    def cipher_blocks (self, states):
+        """Perform AES block cipher on each row of an (N, 16) uint8 array
+
+        Args:
+            states (numpy.array): Blocks to encrypt, shape (N, 16)
+
+        Returns:
+            numpy.array: Encrypted blocks as a new (N, 16) uint8 array
+        """
+        return _cipher_blocks(states, self._np_round_keys)
+
+    def decipher_blocks (self, states):
+        """Perform AES block decipher on each row of an (N, 16) uint8 array
+
+        Args:
+            states (numpy.array): Blocks to decrypt, shape (N, 16)
+
+        Returns:
+            numpy.array: Decrypted blocks as a new (N, 16) uint8 array
+        """
+        return _decipher_blocks(states, self._np_round_keys)
+
+
+class BatchKeyAESCipher:
+    """Perform AES cipher/decipher on (N, 16) arrays of blocks that each have their own key
+
+    The arrays passed to cipher_blocks and decipher_blocks must have one row per key.
+
+    Args:
+        round_keys (numpy.array): uint8 round keys, shape (N, rounds+1, 16), such as
+                                    from :func:`key_schedule.key_expansion_batch`
+    """
+
+    def __init__ (self, round_keys):
+        round_keys = np.asarray(round_keys, dtype=np.uint8)
+        self._Nr = round_keys.shape[1] - 1
+
+        #(Nr+1, N, 16) so each round's keys broadcast against the (N, 16) states
+        self._np_round_keys = np.ascontiguousarray(round_keys.transpose(1, 0, 2))
+
+    def cipher_blocks (self, states):
+        """Perform AES block cipher on each row of an (N, 16) uint8 array, with the matching row's key
+
+        Args:
+            states (numpy.array): Blocks to encrypt, shape (N, 16)
+
+        Returns:
+            numpy.array: Encrypted blocks as a new (N, 16) uint8 array
+        """
+        return _cipher_blocks(states, self._np_round_keys)
+
+    def decipher_blocks (self, states):
+        """Perform AES block decipher on each row of an (N, 16) uint8 array, with the matching row's key
+
+        Args:
+            states (numpy.array): Blocks to decrypt, shape (N, 16)
+
+        Returns:
+            numpy.array: Decrypted blocks as a new (N, 16) uint8 array
+        """
+        return _decipher_blocks(states, self._np_round_keys)
+
+class TTableAESCipher(AESCipher):
+    """Perform single block AES cipher/decipher using 32 bit T-tables
+
+    Drop-in replacement for AESCipher that combines sub bytes, shift rows and mix columns
+    into four table lookups per column. cipher_block and decipher_block take lists,
+    bytes or bytearrays and return lists, or bytes if given bytes/bytearray. Round keys
+    are converted to words once, when the cipher is created.
+    """
+
+    def __init__ (self, expanded_key):
+        super().__init__(expanded_key)
+        rk = struct.unpack(">{}I".format(4*(self._Nr+1)), bytes(expanded_key))
+        self._enc_keys = [rk[4*i:4*i+4] for i in range(self._Nr+1)]
+
+        #Decryption uses the equivalent inverse cipher, with inverse mix columns
+        #applied to the middle round keys
+        m0,m1,m2,m3 = _Tmix_i
+        self._dec_keys = [tuple(m0[w>>24]^m1[(w>>16)&0xff]^m2[(w>>8)&0xff]^m3[w&0xff] for w in k) \
+                            for k in self._enc_keys]
+        self._dec_keys[0] = self._enc_keys[0]
+        self._dec_keys[self._Nr] = self._enc_keys[self._Nr]
+
+    def cipher_block (self, state):
+        """Perform AES block cipher on input"""
+        as_bytes = isinstance(state, (bytes, bytearray))
+        state = bytes(state)
+        #PKCS7 Padding
+        state += bytes([16-len(state)])*(16-len(state))
+
+        t0,t1,t2,t3 = _Te
+        keys = self._enc_keys
+        k = keys[0]
+        s0,s1,s2,s3 = struct.unpack(">4I", state)
+        s0 ^= k[0]; s1 ^= k[1]; s2 ^= k[2]; s3 ^= k[3]
+
+        for i in range(1, self._Nr):
+            k = keys[i]
+            s0,s1,s2,s3 = (
+                t0[s0>>24]^t1[(s1>>16)&0xff]^t2[(s2>>8)&0xff]^t3[s3&0xff]^k[0],
+                t0[s1>>24]^t1[(s2>>16)&0xff]^t2[(s3>>8)&0xff]^t3[s0&0xff]^k[1],
+                t0[s2>>24]^t1[(s3>>16)&0xff]^t2[(s0>>8)&0xff]^t3[s1&0xff]^k[2],
+                t0[s3>>24]^t1[(s0>>16)&0xff]^t2[(s1>>8)&0xff]^t3[s2&0xff]^k[3])
+
+        sb = aes_tables.sbox
+        out = bytes((
+            sb[s0>>24], sb[(s1>>16)&0xff], sb[(s2>>8)&0xff], sb[s3&0xff],
+            sb[s1>>24], sb[(s2>>16)&0xff], sb[(s3>>8)&0xff], sb[s0&0xff],
+            sb[s2>>24], sb[(s3>>16)&0xff], sb[(s0>>8)&0xff], sb[s1&0xff],
+            sb[s3>>24], sb[(s0>>16)&0xff], sb[(s1>>8)&0xff], sb[s2&0xff]))
+        out = (int.from_bytes(out, "big") ^ _words_int(keys[self._Nr])).to_bytes(16, "big")
+        return out if as_bytes else list(out)
+
+    def decipher_block (self, state):
+        """Perform AES block decipher on input"""
+        as_bytes = isinstance(state, (bytes, bytearray))
+        state = bytes(state)
+        #null padding. Padding actually should not be needed here with valid input.
+        state += bytes(16-len(state))
+
+        t0,t1,t2,t3 = _Td
+        keys = self._dec_keys
+        k = keys[self._Nr]
+        s0,s1,s2,s3 = struct.unpack(">4I", state)
+        s0 ^= k[0]; s1 ^= k[1]; s2 ^= k[2]; s3 ^= k[3]
+
+        for i in range(self._Nr - 1, 0, -1):
+            k = keys[i]
+            s0,s1,s2,s3 = (
+                t0[s0>>24]^t1[(s3>>16)&0xff]^t2[(s2>>8)&0xff]^t3[s1&0xff]^k[0],
+                t0[s1>>24]^t1[(s0>>16)&0xff]^t2[(s3>>8)&0xff]^t3[s2&0xff]^k[1],
+                t0[s2>>24]^t1[(s1>>16)&0xff]^t2[(s0>>8)&0xff]^t3[s3&0xff]^k[2],
+                t0[s3>>24]^t1[(s2>>16)&0xff]^t2[(s1>>8)&0xff]^t3[s0&0xff]^k[3])
+
+        ib = aes_tables.i_sbox
+        out = bytes((
+            ib[s0>>24], ib[(s3>>16)&0xff], ib[(s2>>8)&0xff], ib[s1&0xff],
+            ib[s1>>24], ib[(s0>>16)&0xff], ib[(s3>>8)&0xff], ib[s2&0xff],
+            ib[s2>>24], ib[(s1>>16)&0xff], ib[(s0>>8)&0xff], ib[s3&0xff],
+            ib[s3>>24], ib[(s2>>16)&0xff], ib[(s1>>8)&0xff], ib[s0&0xff]))
+        out = (int.from_bytes(out, "big") ^ _words_int(keys[0])).to_bytes(16, "big")
+        return out if as_bytes else list(out)
+
+def _words_int(words):
+    #Four 32 bit words as one 128 bit integer
+    return (words[0] << 96) | (words[1] << 64) | (words[2] << 32) | words[3]
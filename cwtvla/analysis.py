@@ -1,7 +1,17 @@
 import numpy as np
 from scipy.stats import ttest_ind 
-from .ktp import FixedVRandomText
+from scipy.special import comb
+from .ktp import FixedVRandomText, _expand_aes_key
+from .aes_cipher import AESCipher, BatchKeyAESCipher, _add_round_key_blocks, _sub_bytes_blocks, \
+    _shift_rows_blocks, _mix_columns_blocks
+from .key_schedule import key_expansion_batch
 import logging
+from collections import namedtuple
+from .chunking import DEFAULT_MAX_MEMORY, in_memory, iter_chunks, is_integer, drop_rows
+from .cache import LeakageCache, fingerprint
+from concurrent.futures import ProcessPoolExecutor
+import os
+import math
 
 
 def leakage_lookup(operation, round):
@@ -33,20 +43,43 @@ def leakage_lookup(operation, round):
 
     return 1+(opn)+4*(round-1)
 
-def t_test(group1, group2):
+def t_test(group1, group2, max_memory=DEFAULT_MAX_MEMORY, exclude=None):
     """ Perform a t_test between two numpy arrays.
 
     Splits the data between the first and second half of each group
 
+    Groups can also be zarr arrays, h5py datasets or np.memmap. These are read a chunk
+    at a time into a :class:`TTestAccumulator` instead of being loaded into memory.
+    Integer traces (e.g. raw ADC codes) are also accumulated a chunk at a time, so they're
+    never converted to float64 all at once. 8 and 16 bit traces use exact integer sums, so
+    their results don't depend on the chunk size.
+
     Args:
         group1 (numpy.array): Group 1
         group2 (numpy.array): Group 2
+        max_memory (int): Memory budget in bytes for reading groups that aren't in memory
+        exclude ((list, list)): Indices of traces in group 1 and group 2 to leave out, e.g. the
+                            "bad_traces" attribute stored by :code:`cw_convenience.capture_all()`.
+                            The groups are split in half after these are removed.
 
     Returns:
         numpy.array: A numpy array with two elements spanning the length of the traces. The
         first is between the first half of groups 1 and 2. The second
         is between the second half of the groups.
     """
+    exclude = [np.unique(np.asarray(rows, dtype='int64')) for rows in (exclude or ([], []))]
+    if in_memory(group1) and in_memory(group2) and any(len(rows) for rows in exclude):
+        group1 = np.delete(group1, exclude[0], axis=0)
+        group2 = np.delete(group2, exclude[1], axis=0)
+        exclude = [[], []]
+    if not (in_memory(group1) and in_memory(group2)) or is_integer(group1) or is_integer(group2):
+        exact = exact_integer_traces(group1) and exact_integer_traces(group2)
+        acc = TTestAccumulator(len(group1) - len(exclude[0]), len(group2) - len(exclude[1]), exact=exact)
+        for group_id, group in enumerate((group1, group2)):
+            for start, chunk in drop_rows(iter_chunks(group, max_memory=max_memory), exclude[group_id]):
+                acc.update(group_id, chunk, start)
+        return acc.t()
+
     trace_len = len(group1[0])
     group1_len = len(group1) // 2
     group2_len = len(group2) // 2
@@ -55,6 +88,473 @@ def t_test(group1, group2):
     t[1] = ttest_ind(group1[group1_len:], group2[group2_len:], axis=0, equal_var=False)[0]
     return t
 
+class MomentState:
+    """ Running per-sample central moments for a set of traces.
+
+    Keeps the number of traces, the mean, and the sums of powers of differences
+    from the mean (M2, M3, ... up to max_order) of each sample. Traces are added a chunk
+    at a time, so memory use depends only on the trace length.
+
+    Two states can be combined exactly with :code:`merge()` (Chan et al.'s pairwise
+    update, extended to higher orders by Pebay), so traces can be reduced in separate
+    processes or machines.
+
+    Args:
+        trace_len (int): Number of samples in each trace
+        max_order (int): Highest central moment to keep. Must be at least 2
+    """
+    def __init__(self, trace_len, max_order=2):
+        if max_order < 2:
+            raise ValueError("Invalid max_order {}, must be at least 2".format(max_order))
+        self.n = 0
+        self.max_order = max_order
+        self.mean = np.zeros(trace_len, dtype='float64')
+        self.m = np.zeros((max_order - 1, trace_len), dtype='float64')
+
+    @property
+    def m2(self):
+        """ Sum of squared differences from the mean """
+        return self.m[0]
+
+    def update(self, chunk):
+        """ Add a chunk of traces to the running moments
+
+        Args:
+            chunk (numpy.array): Traces to add, shape (n, trace_len) or (trace_len,)
+        """
+        chunk = np.asarray(chunk, dtype='float64')
+        if chunk.ndim == 1:
+            chunk = chunk[np.newaxis]
+        n_b = len(chunk)
+        if n_b == 0:
+            return
+
+        other = MomentState(chunk.shape[1], self.max_order)
+        other.n = n_b
+        other.mean = np.mean(chunk, axis=0)
+        diff = chunk - other.mean
+        power = diff.copy()
+        for p in range(2, self.max_order + 1):
+            power *= diff
+            other.m[p - 2] = np.sum(power, axis=0)
+        self.merge(other)
+
+    def merge(self, other):
+        """ Combine another MomentState into this one
+
+        The result is the same as if all of other's traces had been added to this state.
+
+        Args:
+            other (MomentState): State to merge in. Not modified.
+
+        Returns:
+            self
+        """
+        if other.max_order != self.max_order:
+            raise ValueError("Can't merge moments of order {} and {}".format(self.max_order, other.max_order))
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n = other.n
+            self.mean = other.mean.copy()
+            self.m = other.m.copy()
+            return self
+
+        n_a, n_b = self.n, other.n
+        n = n_a + n_b
+        delta = other.mean - self.mean
+
+        def moment(st, p):
+            # central sum of order p, M0 = n and M1 = 0
+            return st.m[p - 2] if p >= 2 else 0
+
+        m = np.empty_like(self.m)
+        for p in range(2, self.max_order + 1):
+            m[p - 2] = self.m[p - 2] + other.m[p - 2] \
+                + (n_a * n_b * delta / n)**p * (1 / n_b**(p - 1) - (-1 / n_a)**(p - 1))
+            for k in range(1, p - 1):
+                m[p - 2] += comb(p, k) * delta**k * ((-n_b / n)**k * moment(self, p - k) \
+                    + (n_a / n)**k * moment(other, p - k))
+
+        self.mean = self.mean + delta * (n_b / n)
+        self.m = m
+        self.n = n
+        return self
+
+    def central_moment(self, p):
+        """ p-th central moment (Mp / n) of each sample """
+        if p == 1:
+            return np.zeros_like(self.mean)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.m[p - 2] / self.n
+
+    def variance(self):
+        """ Sample variance (n - 1 denominator) of each sample """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.m2 / (self.n - 1)
+
+    def order_stats(self, order):
+        """ Mean and variance of the traces after univariate preprocessing for a given order
+
+        For order 1 this is just the sample mean and variance. For order 2, the traces are
+        centred and squared. For order 3 and up they are centred, standardized and raised to
+        the order'th power (Schneider and Moradi, "Leakage Assessment Methodology", 2015).
+        Calculated from the central moments, so max_order must be at least 2*order.
+
+        Args:
+            order (int): t-test order
+
+        Returns:
+            mean, variance
+        """
+        if 2 * order > self.max_order:
+            raise ValueError("Order {} t-test needs moments up to {}, only have {}".format(order, 2 * order, self.max_order))
+        if order == 1:
+            return self.mean, self.variance()
+        cm2 = self.central_moment(2)
+        cm_d = self.central_moment(order)
+        cm_2d = self.central_moment(2 * order)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if order == 2:
+                return cm2, cm_2d - cm2**2
+            return cm_d / cm2**(order / 2), (cm_2d - cm_d**2) / cm2**order
+
+
+class IntegerMomentState:
+    """ Exact running sums for integer traces, like raw ADC codes.
+
+    Keeps the number of traces and the int64 sum and sum of squares of each sample.
+    Integer sums are exact, so the result doesn't depend on how the traces are chunked,
+    ordered, or split between workers and merged. Only 8 and 16 bit traces are accepted,
+    so the sums of squares can't overflow for fewer than 2**31 traces.
+
+    Args:
+        trace_len (int): Number of samples in each trace
+    """
+    def __init__(self, trace_len):
+        self.n = 0
+        self.s1 = np.zeros(trace_len, dtype='int64')
+        self.s2 = np.zeros(trace_len, dtype='int64')
+
+    @property
+    def mean(self):
+        """ Mean of each sample """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.s1 / self.n
+
+    def update(self, chunk):
+        """ Add a chunk of traces to the running sums
+
+        Args:
+            chunk (numpy.array): Integer traces to add, shape (n, trace_len) or (trace_len,)
+        """
+        chunk = np.asarray(chunk)
+        if not exact_integer_traces(chunk):
+            raise ValueError("Need 8 or 16 bit integer traces, got {}".format(chunk.dtype))
+        if chunk.ndim == 1:
+            chunk = chunk[np.newaxis]
+        c = chunk.astype('int64')
+        self.s1 += np.sum(c, axis=0)
+        self.s2 += np.sum(c * c, axis=0)
+        self.n += len(c)
+
+    def merge(self, other):
+        """ Combine another IntegerMomentState into this one
+
+        Args:
+            other (IntegerMomentState): State to merge in. Not modified.
+
+        Returns:
+            self
+        """
+        self.n += other.n
+        self.s1 = self.s1 + other.s1
+        self.s2 = self.s2 + other.s2
+        return self
+
+    def variance(self):
+        """ Sample variance (n - 1 denominator) of each sample """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (self.n * self.s2.astype('float64') - self.s1.astype('float64')**2) / (self.n * (self.n - 1))
+
+def exact_integer_traces(array):
+    """ Check if array's traces can be summed exactly by :class:`IntegerMomentState` """
+    return np.issubdtype(array.dtype, np.integer) and array.dtype.itemsize <= 2
+
+def _exact_welch_t(a, b):
+    # Welch's t from two IntegerMomentStates, with the whole statistic kept as an exact
+    # fraction of python ints so the only rounding is the final division and square root
+    t = np.full(len(a.s1), np.nan)
+    if min(a.n, b.n) < 2:
+        return t
+    na, nb = a.n, b.n
+    da, db = na * na * (na - 1), nb * nb * (nb - 1)
+    for j, (s1a, s2a, s1b, s2b) in enumerate(zip(a.s1.tolist(), a.s2.tolist(), b.s1.tolist(), b.s2.tolist())):
+        # t = (dn / (na*nb)) / sqrt(vn / (da*db))
+        dn = s1a * nb - s1b * na
+        vn = (na * s2a - s1a * s1a) * db + (nb * s2b - s1b * s1b) * da
+        if vn == 0:
+            t[j] = np.nan if dn == 0 else math.copysign(math.inf, dn)
+        else:
+            t[j] = math.copysign(math.sqrt(dn * dn * da * db / (vn * (na * nb)**2)), dn)
+    return t
+
+def _welch_t(a, b, order=1):
+    # Welch's t statistic between two MomentStates, same as ttest_ind(equal_var=False) for order 1
+    mean_a, var_a = a.order_stats(order)
+    mean_b, var_b = b.order_stats(order)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (mean_a - mean_b) / np.sqrt(var_a / a.n + var_b / b.n)
+
+
+class TTestAccumulator:
+    """ Streaming version of :func:`t_test`.
+
+    Traces are added a chunk at a time with :code:`update()` instead of
+    needing both groups in memory at once. Only the per-sample count,
+    mean and central moments are kept for each half of each group, so memory use depends only on
+    the trace length, not the number of traces.
+
+    Higher order (univariate) t-tests can be done by setting order. These are useful for
+    evaluating masked implementations, which should pass first order tests.
+
+    The results are split into halves the same way as :func:`t_test`, so the number
+    of traces that will end up in each group must be known up front.
+
+    Usage::
+
+        import cwtvla
+        acc = cwtvla.TTestAccumulator(N)
+        for i in range(0, N, 1000):
+            acc.update(0, group1[i:i+1000])
+            acc.update(1, group2[i:i+1000])
+        t_val = acc.t()
+        fail_points = cwtvla.check_t_test(t_val)
+
+    Accumulators can also be reduced separately and merged, for example when traces
+    are captured on several stations. Each shard passes the index of its traces
+    within the full group so the halves line up with :func:`t_test`::
+
+        # on each station
+        acc = cwtvla.TTestAccumulator(N)
+        acc.update(0, my_group1, start=my_start)
+        acc.update(1, my_group2, start=my_start)
+        acc.save("shard{}.npz".format(station))
+
+        # on the reducer
+        acc = cwtvla.TTestAccumulator.load("shard0.npz")
+        for i in range(1, n_stations):
+            acc.merge(cwtvla.TTestAccumulator.load("shard{}.npz".format(i)))
+        fail_points = cwtvla.check_t_test(acc.t())
+
+    For 8 or 16 bit integer traces (e.g. raw ADC codes), exact=True keeps exact integer
+    sums (see :class:`IntegerMomentState`) instead of floating point moments. The t-test is
+    then the same bit for bit however the traces are chunked or split between accumulators.
+
+    Args:
+        group1_len (int): Total number of traces that will be added to group 1
+        group2_len (int): Total number of traces that will be added to group 2. If None,
+                            the same as group1_len
+        order (int): Order of the t-test. 1 is the same as :func:`t_test`, 2 and 3 test
+                            the variance and skewness of the traces.
+        exact (bool): Use exact integer sums. Only for order 1 and integer traces.
+    """
+    def __init__(self, group1_len, group2_len=None, order=1, exact=False):
+        if group2_len is None:
+            group2_len = group1_len
+        if order < 1:
+            raise ValueError("Invalid order {}, must be at least 1".format(order))
+        if exact and order != 1:
+            raise ValueError("Exact integer t-tests are only supported for order 1")
+        self.order = order
+        self.exact = exact
+        self._group_len = [group1_len, group2_len]
+        self._next = [0, 0]
+        self._states = None
+
+    def update(self, group_id, chunk, start=None):
+        """ Add a chunk of traces to one of the groups
+
+        Args:
+            group_id (int): 0 for group 1, 1 for group 2
+            chunk (numpy.array): Traces to add, shape (n, trace_len)
+            start (int): Index of the first trace of chunk within its group, as it would be in the
+                            arrays passed to :func:`t_test`. If None, follows on from the previous chunk.
+        """
+        if group_id not in (0, 1):
+            raise ValueError("Invalid group_id {}, must be 0 or 1".format(group_id))
+        chunk = np.asarray(chunk)
+        if chunk.ndim == 1:
+            chunk = chunk[np.newaxis]
+        self._init_states(chunk.shape[1])
+
+        if start is None:
+            start = self._next[group_id]
+        if start + len(chunk) > self._group_len[group_id]:
+            raise ValueError("Too many traces for group {}: expected {}".format(group_id, self._group_len[group_id]))
+
+        half_len = self._group_len[group_id] // 2
+        split = min(max(half_len - start, 0), len(chunk))
+        self._states[group_id][0].update(chunk[:split])
+        self._states[group_id][1].update(chunk[split:])
+        self._next[group_id] = start + len(chunk)
+
+    def merge(self, other):
+        """ Combine the traces from another accumulator into this one
+
+        Both accumulators must have been created with the same group lengths and
+        must not contain the same traces.
+
+        Args:
+            other (TTestAccumulator): Accumulator to merge in. Not modified.
+
+        Returns:
+            self
+        """
+        if self._group_len != other._group_len:
+            raise ValueError("Can't merge accumulators with different group lengths {} and {}".format(self._group_len, other._group_len))
+        if self.order != other.order:
+            raise ValueError("Can't merge accumulators with different orders {} and {}".format(self.order, other.order))
+        if self.exact != other.exact:
+            raise ValueError("Can't merge exact and floating point accumulators")
+        if other._states is None:
+            return self
+        self._init_states(len(other._states[0][0].mean))
+        for group_id in range(2):
+            for half in range(2):
+                self._states[group_id][half].merge(other._states[group_id][half])
+            self._next[group_id] = max(self._next[group_id], other._next[group_id])
+        return self
+
+    def _init_states(self, trace_len):
+        if self._states is None:
+            if self.exact:
+                self._states = [[IntegerMomentState(trace_len), IntegerMomentState(trace_len)] for _ in range(2)]
+                return
+            max_order = max(2, 2 * self.order)
+            self._states = [[MomentState(trace_len, max_order), MomentState(trace_len, max_order)] for _ in range(2)]
+        elif len(self._states[0][0].mean) != trace_len:
+            raise ValueError("Trace length {} doesn't match previous traces ({})".format(trace_len, len(self._states[0][0].mean)))
+
+    def _to_arrays(self):
+        if self._states is None:
+            raise ValueError("No traces have been added")
+        states = [st for group in self._states for st in group]
+        arrays = {
+            "order": np.array(self.order, dtype='int64'),
+            "group_len": np.array(self._group_len, dtype='int64'),
+            "next": np.array(self._next, dtype='int64'),
+            "n": np.array([st.n for st in states], dtype='int64'),
+        }
+        if self.exact:
+            arrays["s1"] = np.stack([st.s1 for st in states])
+            arrays["s2"] = np.stack([st.s2 for st in states])
+        else:
+            arrays["mean"] = np.stack([st.mean for st in states])
+            arrays["m"] = np.stack([st.m for st in states])
+        return arrays
+
+    @classmethod
+    def _from_arrays(cls, arrays):
+        exact = "s1" in arrays
+        acc = cls(*[int(x) for x in arrays["group_len"]], order=int(arrays["order"]), exact=exact)
+        acc._next = [int(x) for x in arrays["next"]]
+        acc._init_states(arrays["s1" if exact else "mean"].shape[1])
+        for i, st in enumerate([st for group in acc._states for st in group]):
+            st.n = int(arrays["n"][i])
+            if exact:
+                st.s1 = np.array(arrays["s1"][i], dtype='int64')
+                st.s2 = np.array(arrays["s2"][i], dtype='int64')
+            else:
+                st.mean = np.array(arrays["mean"][i], dtype='float64')
+                st.m = np.array(arrays["m"][i], dtype='float64')
+        return acc
+
+    def save(self, file):
+        """ Save the accumulator state to a .npz file
+
+        Args:
+            file (str or file): Passed to numpy.savez
+        """
+        np.savez(file, **self._to_arrays())
+
+    @classmethod
+    def load(cls, file):
+        """ Load an accumulator saved with :code:`save()`
+
+        Args:
+            file (str or file): Passed to numpy.load
+
+        Returns:
+            TTestAccumulator
+        """
+        with np.load(file) as arrays:
+            return cls._from_arrays(arrays)
+
+    def save_zarr(self, group):
+        """ Save the accumulator state into a zarr group
+
+        Args:
+            group (zarr.Group): Group to store the state arrays in. Existing arrays are overwritten.
+        """
+        for name, arr in self._to_arrays().items():
+            group.array(name, arr, overwrite=True)
+
+    @classmethod
+    def load_zarr(cls, group):
+        """ Load an accumulator saved with :code:`save_zarr()`
+
+        Args:
+            group (zarr.Group): Group the state was saved in
+
+        Returns:
+            TTestAccumulator
+        """
+        names = ("order", "group_len", "next", "n", "mean", "m", "s1", "s2")
+        return cls._from_arrays({name: group[name][...] for name in names if name in group})
+
+    def t(self):
+        """ Calculate the t-test from the traces added so far
+
+        Returns:
+            numpy.array: Same format as :func:`t_test`. Halves without at least two traces in each
+            group are nan.
+        """
+        if self._states is None:
+            raise ValueError("No traces have been added")
+        (g1_0, g1_1), (g2_0, g2_1) = self._states
+        t = np.zeros([2, len(g1_0.mean)], dtype='float64')
+        if self.exact:
+            t[0] = _exact_welch_t(g1_0, g2_0)
+            t[1] = _exact_welch_t(g1_1, g2_1)
+            return t
+        t[0] = _welch_t(g1_0, g2_0, self.order)
+        t[1] = _welch_t(g1_1, g2_1, self.order)
+        return t
+
+def higher_order_t_test(group1, group2, order=2, chunk_len=None, max_memory=DEFAULT_MAX_MEMORY):
+    """ Perform a higher order univariate t_test between two arrays of traces.
+
+    The central moments needed are accumulated in a single pass over chunk_len traces
+    at a time, so no centred or squared copies of the full trace arrays are made.
+    Groups can also be zarr arrays, h5py datasets or np.memmap.
+
+    Args:
+        group1 (numpy.array): Group 1
+        group2 (numpy.array): Group 2
+        order (int): Order of the test, usually 2 or 3
+        chunk_len (int): Number of traces to process at once. If None, picked from max_memory
+        max_memory (int): Memory budget in bytes for each chunk
+
+    Returns:
+        numpy.array: Same format as :func:`t_test`
+    """
+    acc = TTestAccumulator(len(group1), len(group2), order=order)
+    for group_id, group in enumerate((group1, group2)):
+        for start, chunk in iter_chunks(group, chunk_len, max_memory):
+            acc.update(group_id, chunk, start)
+    return acc.t()
+
 def leakage_func_bit(text, byte, bit, cipher, op_in, op_out):
     """ A generic leakage function for testing a bit in the AES state
 
@@ -153,6 +653,109 @@ def leakage_func_byte(text, byte, val, cipher, op_in, op_out):
     return int((states[op_in][byte] ^ states[op_out][byte]) == val)
 
 
+def aes_states(textins, key):
+    """ Calculate every intermediate AES state for a batch of plaintexts
+
+    The whole batch is encrypted at once with table lookups. States are indexed
+    the same way as :func:`leakage_lookup`, with state 0 being all zeros.
+
+    Args:
+        textins (numpy.array): Plaintexts, shape (N, 16)
+        key (iterable): AES key used for encryption, 16, 24, or 32 bytes, or an
+                        (N, key_len) array with a key for each plaintext
+
+    Returns:
+        numpy.array: uint8 array of shape (N, n_states, 16)
+    """
+    textins = np.asarray(textins, dtype=np.uint8)
+    if np.ndim(key) == 2:
+        cipher = BatchKeyAESCipher(key_expansion_batch(key))
+    else:
+        cipher = AESCipher(_expand_aes_key(key))
+    n_states = 4*cipher._Nr - 1
+    states = np.zeros((len(textins), n_states, 16), dtype=np.uint8)
+
+    state = np.array(textins, dtype=np.uint8, order='C')
+    _add_round_key_blocks(state, cipher._np_round_keys, 0)
+    idx = 1
+    for i in range(1, cipher._Nr):
+        states[:, idx] = state
+        _sub_bytes_blocks(state)
+
+        states[:, idx+1] = state
+        _shift_rows_blocks(state)
+
+        states[:, idx+2] = state
+        _mix_columns_blocks(state, False)
+
+        states[:, idx+3] = state
+        _add_round_key_blocks(state, cipher._np_round_keys, i)
+        idx += 4
+
+    states[:, idx] = state
+    _sub_bytes_blocks(state)
+
+    states[:, idx+1] = state
+    return states
+
+def _cached_aes_states(textins, key, cache):
+    # aes_states, loaded from cache if it's there
+    if cache is None:
+        return aes_states(textins, key)
+    textins = np.asarray(textins, dtype=np.uint8)
+    key = np.asarray(key, dtype=np.uint8)
+    return cache.get_or_compute(fingerprint("aes_states", textins, key), lambda: aes_states(textins, key))
+
+def leakage_states_bit(states, byte, bit, op_in, op_out):
+    """ Vectorized version of :func:`leakage_func_bit`
+
+    Args:
+        states (numpy.array): Intermediate states from :func:`aes_states`
+        byte (int): Which byte to get the leakage for
+        bit (int): Which bit to get the leakage for
+        op_in (int): Use the state after operation op_in. If 0, an array of 0 is used (useful for HW)
+        op_out (int): Use the state after operation op_out. If 0, an array of 0 is used (useful for HW)
+
+    Returns:
+        numpy.array: 1 where the bit under test is 1, 0 where it is 0, for each trace
+    """
+    if op_in == op_out:
+        raise ValueError("Opin and opout can't be the same value!")
+    return ((states[:, op_in, byte] ^ states[:, op_out, byte]) >> bit) & 1
+
+def leakage_states_byte(states, byte, val, op_in, op_out):
+    """ Vectorized version of :func:`leakage_func_byte`
+
+    Args:
+        states (numpy.array): Intermediate states from :func:`aes_states`
+        byte (int): Which byte to get the leakage for
+        val (int): The val to separate based on
+        op_in (int): Use the state after operation op_in. If 0, an array of 0 is used (useful for HW)
+        op_out (int): Use the state after operation op_out. If 0, an array of 0 is used (useful for HW)
+
+    Returns:
+        numpy.array: 1 where state_byte == val, 0 elsewhere, for each trace
+    """
+    if op_in == op_out:
+        raise ValueError("Opin and opout can't be the same value!")
+    return ((states[:, op_in, byte] ^ states[:, op_out, byte]) == val).astype(np.uint8)
+
+def leakage_states_value(states, byte, op_in, op_out):
+    """ Get the value of a byte for :func:`leakage_states_byte` without comparing it to a val
+
+    Args:
+        states (numpy.array): Intermediate states from :func:`aes_states`
+        byte (int): Which byte to get the leakage for
+        op_in (int): Use the state after operation op_in. If 0, an array of 0 is used (useful for HW)
+        op_out (int): Use the state after operation op_out. If 0, an array of 0 is used (useful for HW)
+
+    Returns:
+        numpy.array: st0[byte] ^ st1[byte] for each trace
+    """
+    if op_in == op_out:
+        raise ValueError("Opin and opout can't be the same value!")
+    return states[:, op_in, byte] ^ states[:, op_out, byte]
+
 def construct_leakage_bit(operation_in, operation_out, round_offset=0):
     """ Construct a leakage function using func between operation_in and operation_out
 
@@ -164,9 +767,13 @@ def construct_leakage_bit(operation_in, operation_out, round_offset=0):
         round_offset (int): How many rounds to offset operation_out
 
     Returns:
-        function(text, byte, bit, cipher, rnd): leakage function
+        function(text, byte, bit, cipher, rnd): leakage function. Its states_func attribute,
+        function(states, byte, bit, rnd), is the vectorized version for use with :func:`aes_states`
     """
-    return lambda text, byte, bit, cipher, rnd: leakage_func_bit(text, byte, bit, cipher, leakage_lookup(operation_in, rnd), leakage_lookup(operation_out, rnd+round_offset))
+    func = lambda text, byte, bit, cipher, rnd: leakage_func_bit(text, byte, bit, cipher, leakage_lookup(operation_in, rnd), leakage_lookup(operation_out, rnd+round_offset))
+    func.states_func = lambda states, byte, bit, rnd: leakage_states_bit(states, byte, bit, leakage_lookup(operation_in, rnd), leakage_lookup(operation_out, rnd+round_offset))
+    func.description = "bit({}, {}, round_offset={})".format(operation_in, operation_out, round_offset)
+    return func
 
 def construct_leakage_byte(operation_in, operation_out, round_offset=0):
     """ Construct a leakage function using func between operation_in and operation_out
@@ -179,18 +786,55 @@ def construct_leakage_byte(operation_in, operation_out, round_offset=0):
         round_offset (int): How many rounds to offset operation_out
 
     Returns:
-        function(text, byte, bit, cipher, rnd): leakage function
+        function(text, byte, bit, cipher, rnd): leakage function. Its states_func attribute,
+        function(states, byte, val, rnd), is the vectorized version for use with :func:`aes_states`,
+        and its value_func attribute, function(states, byte, rnd), returns the byte value itself
+        for :func:`eval_byte_values`
     """
-    return lambda text, byte, bit, cipher, rnd: leakage_func_byte(text, byte, bit, cipher, leakage_lookup(operation_in, rnd), leakage_lookup(operation_out, rnd+round_offset))
+    func = lambda text, byte, bit, cipher, rnd: leakage_func_byte(text, byte, bit, cipher, leakage_lookup(operation_in, rnd), leakage_lookup(operation_out, rnd+round_offset))
+    func.states_func = lambda states, byte, bit, rnd: leakage_states_byte(states, byte, bit, leakage_lookup(operation_in, rnd), leakage_lookup(operation_out, rnd+round_offset))
+    func.value_func = lambda states, byte, rnd: leakage_states_value(states, byte, leakage_lookup(operation_in, rnd), leakage_lookup(operation_out, rnd+round_offset))
+    func.description = "byte({}, {}, round_offset={})".format(operation_in, operation_out, round_offset)
+    return func
+
+def _leakage_model_name(func):
+    # description of a leakage function for storing with results
+    return getattr(func, "description", getattr(func, "__name__", repr(func)))
+
+def _report_t_test(t_val, plot):
+    # print the result of a t_test and optionally plot it
+    fail_points = check_t_test(t_val)
+    if len(fail_points) > 0:
+        print("Test failed at points {}".format(fail_points))
+    else:
+        print("Passed test")
+    if plot:
+        try:
+            import matplotlib.pyplot as plt
+        except:
+            logging.error("Matplotlib required for plotting")
+        plt.cla()
+        plt.plot(t_val[0])
+        plt.plot(t_val[1])
+        plt.draw()
+        plt.pause(0.0001)
 
-def eval_rand_v_rand(waves, textins, func, key_len=16, round_range=None, byte_range=None, bit_range=None, plot=False):
+def eval_rand_v_rand(waves, textins, func, key_len=16, round_range=None, byte_range=None, bit_range=None, plot=False,
+                        max_memory=DEFAULT_MAX_MEMORY, n_jobs=1, cache=None):
     """ Evaluate rand_v_rand traces using a leakage function.
 
     Separates waves using textins and the leakage func, then does a t_test between them.
+    If func has a states_func attribute (like those from :func:`construct_leakage_bit`), every
+    intermediate state is calculated once with :func:`aes_states` and the traces are separated using
+    states_func instead.
 
     Done for rounds in round_range, for bytes in byte_range, and bits (or vals) in bit range. Can
     also plot for each test.
 
+    If waves isn't an in memory numpy array (e.g. a zarr array or np.memmap), or n_jobs isn't 1,
+    the tests are done with :func:`eval_rand_v_rand_batch`, which reads waves a chunk at a time
+    and can spread the tests over several processes.
+
     Args:
         waves (np.array): Rand V Rand Trace waves
         textins (np.array): Rand V Rand plaintexts
@@ -200,67 +844,806 @@ def eval_rand_v_rand(waves, textins, func, key_len=16, round_range=None, byte_ra
         byte_range (iterable): Bytes to test
         bit_range (iterable): Bits to test (or vals if using a byte leakage func)
         plot (bool): Plot t_test results?
+        max_memory (int): Memory budget in bytes for reading waves that aren't in memory
+        n_jobs (int): Number of processes to spread the tests over. -1 uses every core.
+        cache (LeakageCache): Optional cache for the intermediate states (and selectors if batched)
 
+    Returns:
+        TVLAResultSet: t_test results for every test
     """
+    if not in_memory(waves) or n_jobs != 1:
+        results = eval_rand_v_rand_batch(waves, textins, func, key_len, round_range, byte_range, bit_range,
+                                            max_memory=max_memory, n_jobs=n_jobs, cache=cache)
+        for t_val in results.t:
+            _report_t_test(t_val, plot)
+        return results
+
     ktp = FixedVRandomText(key_len)
     cipher = ktp._dev_cipher
-    if round_range is None:
-        round_range = range(2, 9+(key_len//4 - 4) + 1)
-    if byte_range is None:
-        byte_range = range(0, 16)
-    if bit_range is None:
-        bit_range = range(0, 8)
+    round_range, byte_range, bit_range = _rand_v_rand_ranges(key_len, round_range, byte_range, bit_range)
+    states_func = getattr(func, "states_func", None)
+    if states_func is not None:
+        states = _cached_aes_states(textins[:len(waves)], ktp._K_dev, cache)
+    t_vals, n_traces, tests = [], [], []
     for rnd in round_range:
         for byte in byte_range:
             for bit in bit_range:
-                truth_array = np.array([func(textins[i], byte, bit, cipher, rnd) for i in range(len(waves))])
+                if states_func is not None:
+                    truth_array = states_func(states, byte, bit, rnd)
+                else:
+                    truth_array = np.array([func(textins[i], byte, bit, cipher, rnd) for i in range(len(waves))])
                 group1 = waves[truth_array != 0]
                 group2 = waves[truth_array == 0]
                 t_val = t_test(group1, group2)
-                fail_points = check_t_test(t_val)
-                if len(fail_points) > 0:
-                    print("Test failed at points {}".format(fail_points))
-                else:
-                    print("Passed test")
-                if plot:
-                    try:
-                        import matplotlib.pyplot as plt
-                    except:
-                        logging.error("Matplotlib required for plotting")
-                    plt.cla()
-                    plt.plot(t_val[0])
-                    plt.plot(t_val[1])
-                    plt.draw()
-                    plt.pause(0.0001)
+                t_vals.append(t_val)
+                n_traces.append((len(group1), len(group2)))
+                tests.append((rnd, byte, bit))
+                _report_t_test(t_val, plot)
+    return TVLAResultSet(np.array(t_vals), n_traces, tests, leakage_model=_leakage_model_name(func))
+
+def _rand_v_rand_ranges(key_len, round_range, byte_range, bit_range):
+    # default round/byte/bit ranges for rand_v_rand tests
+    if round_range is None:
+        round_range = range(2, 9+(key_len//4 - 4) + 1)
+    if byte_range is None:
+        byte_range = range(0, 16)
+    if bit_range is None:
+        bit_range = range(0, 8)
+    return round_range, byte_range, bit_range
+
+def leakage_selectors(textins, func, key_len=16, round_range=None, byte_range=None, bit_range=None, cache=None):
+    """ Build the selector matrix for a set of rand_v_rand tests
+
+    Column k of the result is the truth array for the k'th (round, byte, bit) test, i.e.
+    1 for traces that go in group 1 and 0 for traces that go in group 2.
+
+    If a cache is given, the intermediate states and the selector matrix are stored in it,
+    keyed by textins, the key, and the tests. The selector matrix is only cached for leakage
+    functions with a description attribute, like those from :func:`construct_leakage_bit`.
+
+    Args:
+        textins (np.array): Rand V Rand plaintexts
+        func (function(textin, byte, bit, cipher, round)): Leakage to function used to separate traces
+        key_len (int): length of key used in bytes
+        round_range (iterable): Rounds to test
+        byte_range (iterable): Bytes to test
+        bit_range (iterable): Bits to test (or vals if using a byte leakage func)
+        cache (LeakageCache): Optional cache for the states and selector matrix
+
+    Returns:
+        (numpy.array, list): uint8 selector matrix of shape (N, K) and a list of the
+        (round, byte, bit) for each of the K tests
+    """
+    ktp = FixedVRandomText(key_len)
+    round_range, byte_range, bit_range = _rand_v_rand_ranges(key_len, round_range, byte_range, bit_range)
+    textins = np.asarray(textins, dtype=np.uint8)
+    tests = [(rnd, byte, bit) for rnd in round_range for byte in byte_range for bit in bit_range]
+
+    description = getattr(func, "description", None)
+    if cache is not None and description is not None:
+        key = fingerprint("selectors", textins, np.asarray(ktp._K_dev, dtype=np.uint8), description, tests)
+        compute = lambda: _leakage_selectors(textins, func, ktp, tests, cache)
+        return cache.get_or_compute(key, compute), tests
+    return _leakage_selectors(textins, func, ktp, tests, cache), tests
+
+def _leakage_selectors(textins, func, ktp, tests, cache):
+    cipher = ktp._dev_cipher
+    states_func = getattr(func, "states_func", None)
+    if states_func is not None:
+        states = _cached_aes_states(textins, ktp._K_dev, cache)
+    selectors = np.zeros((len(textins), len(tests)), dtype=np.uint8)
+    for k, (rnd, byte, bit) in enumerate(tests):
+        if states_func is not None:
+            truth_array = states_func(states, byte, bit, rnd)
+        else:
+            truth_array = np.array([func(textins[i], byte, bit, cipher, rnd) for i in range(len(textins))])
+        selectors[:, k] = truth_array != 0
+    return selectors
+
+def specific_t_test(waves, selectors, chunk_len=None, test_block=128, max_memory=DEFAULT_MAX_MEMORY, n_jobs=1):
+    """ Do many t_tests between the same traces split into different groups
+
+    Equivalent to running :code:`t_test(waves[sel != 0], waves[sel == 0])` for each column sel of
+    selectors, but instead of copying the traces for each test, the sums and sums of squares of every
+    group are calculated with a few matrix products (:code:`selectors.T @ waves` and
+    :code:`selectors.T @ waves**2`) over chunk_len traces at a time. waves can also be a zarr
+    array, h5py dataset or np.memmap.
+
+    Args:
+        waves (np.array): Trace waves, shape (N, samples)
+        selectors (np.array): Selector matrix of shape (N, K) from :func:`leakage_selectors`
+        chunk_len (int): Number of traces to process at once. If None, picked from max_memory
+        test_block (int): Max number of tests to accumulate at once. Each takes
+                            8*8*samples bytes of memory. Waves are read once for each block.
+        max_memory (int): Memory budget in bytes for each chunk of waves
+        n_jobs (int): Number of processes to spread blocks of tests over. -1 uses every core.
+                            In memory waves are put in shared memory once instead of being sent to
+                            each process (this needs python 3.8 or later). Setting OMP_NUM_THREADS=1
+                            avoids the processes competing for cores with numpy's own threads.
+
+    Returns:
+        numpy.array: Array of shape (K, 2, samples), with a :func:`t_test` result for each test
+    """
+    selectors = np.asarray(selectors) != 0
+    n_traces, n_tests = selectors.shape
+    trace_len = waves.shape[1]
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if n_jobs > 1:
+        # make sure every process gets at least one block
+        test_block = max(1, min(test_block, -(-n_tests // n_jobs)))
+    blocks = [(k0, min(k0 + test_block, n_tests)) for k0 in range(0, n_tests, test_block)]
+
+    t = np.zeros((n_tests, 2, trace_len), dtype='float64')
+    if n_jobs <= 1 or len(blocks) <= 1:
+        for k0, k1 in blocks:
+            t[k0:k1] = _specific_t_test_block(waves, selectors[:, k0:k1], chunk_len, max_memory)
+        return t
+
+    shared = []
+    try:
+        waves_desc = _share_array(waves, shared)
+        sel_desc = _share_array(selectors, shared)
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_pool_worker,
+                                    initargs=(waves_desc, sel_desc)) as pool:
+            tasks = [(k0, k1, chunk_len, max_memory) for k0, k1 in blocks]
+            # map returns results in the same order as blocks
+            for (k0, k1), t_block in zip(blocks, pool.map(_pool_specific_t_test, tasks)):
+                t[k0:k1] = t_block
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+    return t
+
+def _specific_t_test_block(waves, sel, chunk_len, max_memory):
+    # specific_t_test for one block of tests, sel is a bool array of shape (N, k)
+    trace_len = waves.shape[1]
+    k_len = sel.shape[1]
+    # shifting by a trace makes sums of squares better conditioned
+    shift = np.array(waves[0], dtype='float64')
+
+    # rows [g1 half0, g1 half1, g2 half0, g2 half1] for every test
+    groups = np.concatenate([sel, ~sel], axis=1)
+    half_len = np.sum(groups, axis=0) // 2
+    seen = np.zeros(2*k_len, dtype='int64')
+    n = np.zeros(4*k_len, dtype='int64')
+    sums = np.zeros((4*k_len, trace_len), dtype='float64')
+    sq_sums = np.zeros((4*k_len, trace_len), dtype='float64')
+
+    for i, chunk in iter_chunks(waves, chunk_len, max_memory):
+        chunk = np.asarray(chunk, dtype='float64') - shift
+        g = groups[i:i+len(chunk)]
+        rank = seen + np.cumsum(g, axis=0)
+        seen = rank[-1]
+        first = g & (rank <= half_len)
+        second = g & (rank > half_len)
+        m = np.empty((len(g), 4*k_len), dtype='float64')
+        m[:, 0::2] = first
+        m[:, 1::2] = second
+        n += np.sum(m, axis=0, dtype='int64')
+        sums += m.T @ chunk
+        np.square(chunk, out=chunk)
+        sq_sums += m.T @ chunk
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums / n[:, np.newaxis]
+        var = (sq_sums - sums * mean) / (n[:, np.newaxis] - 1)
+        mean = mean.reshape(2, k_len, 2, trace_len)
+        var_n = (var / n[:, np.newaxis]).reshape(2, k_len, 2, trace_len)
+        return (mean[0] - mean[1]) / np.sqrt(var_n[0] + var_n[1])
+
+def _memmap_file_offset(array):
+    # byte offset of array's first element in its file, or None if it can't be worked out.
+    # Slices of a memmap keep their parent's .offset, so it's found from where the data
+    # sits in the underlying mmap, which numpy maps from offset rounded down to ALLOCATIONGRANULARITY
+    mm = getattr(array, "_mmap", None)
+    if mm is None or array.filename is None or not array.flags.c_contiguous:
+        return None
+    import mmap
+    map_start = array.offset - array.offset % mmap.ALLOCATIONGRANULARITY
+    map_address = np.frombuffer(mm, dtype='uint8').ctypes.data
+    return map_start + array.ctypes.data - map_address
+
+def _share_array(array, shared):
+    # describe array so a worker process can get it without pickling its data
+    # in memory arrays are copied into shared memory once, which is added to shared
+    offset = _memmap_file_offset(array) if isinstance(array, np.memmap) else None
+    if offset is not None:
+        return ("memmap", array.filename, offset, array.shape, array.dtype.str)
+    if isinstance(array, np.memmap):
+        array = np.ascontiguousarray(array)
+    if not in_memory(array):
+        # zarr/h5py arrays are pickled as a reference to their storage
+        return ("array", array)
+    # needs python 3.8, so it's only imported when n_jobs > 1
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    shared.append(shm)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return ("shm", shm.name, array.shape, array.dtype.str)
+
+def _attach_array(desc):
+    # inverse of _share_array, run in the worker process
+    kind = desc[0]
+    if kind == "memmap":
+        _, filename, offset, shape, dtype = desc
+        return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+    if kind == "array":
+        return desc[1]
+    _, name, shape, dtype = desc
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    _pool_state.setdefault("shm", []).append(shm)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+_pool_state = {}
+
+def _init_pool_worker(waves_desc, sel_desc):
+    _pool_state["waves"] = _attach_array(waves_desc)
+    _pool_state["selectors"] = _attach_array(sel_desc)
+
+def _pool_specific_t_test(task):
+    k0, k1, chunk_len, max_memory = task
+    return _specific_t_test_block(_pool_state["waves"], _pool_state["selectors"][:, k0:k1], chunk_len, max_memory)
+
+def eval_rand_v_rand_batch(waves, textins, func, key_len=16, round_range=None, byte_range=None, bit_range=None,
+                            chunk_len=None, test_block=128, max_memory=DEFAULT_MAX_MEMORY, n_jobs=1, cache=None):
+    """ Evaluate rand_v_rand traces for every test in a single pass.
+
+    Same tests as :func:`eval_rand_v_rand`, but builds the selector matrix for all of them with
+    :func:`leakage_selectors` and calculates the t_tests together with :func:`specific_t_test`.
+
+    Args:
+        waves (np.array): Rand V Rand Trace waves
+        textins (np.array): Rand V Rand plaintexts
+        func (function(textin, byte, bit, cipher, round)): Leakage to function used to separate traces
+        key_len (int): length of key used in bytes
+        round_range (iterable): Rounds to test
+        byte_range (iterable): Bytes to test
+        bit_range (iterable): Bits to test (or vals if using a byte leakage func)
+        chunk_len (int): Number of traces to process at once. If None, picked from max_memory
+        test_block (int): Max number of tests to accumulate at once
+        max_memory (int): Memory budget in bytes for each chunk of waves
+        n_jobs (int): Number of processes to spread the tests over, see :func:`specific_t_test`
+        cache (LeakageCache): Optional cache for the states and selectors, see :func:`leakage_selectors`
+
+    Returns:
+        TVLAResultSet: t_test results for every test. :code:`results.t` has shape (K, 2, samples)
+    """
+    selectors, tests = leakage_selectors(textins[:len(waves)], func, key_len, round_range, byte_range, bit_range,
+                                            cache=cache)
+    t = specific_t_test(waves, selectors, chunk_len, test_block, max_memory, n_jobs)
+    n_group1 = np.sum(selectors != 0, axis=0)
+    n_traces = np.stack([n_group1, len(selectors) - n_group1], axis=1)
+    return TVLAResultSet(t, n_traces, tests, leakage_model=_leakage_model_name(func))
+
+def byte_value_t_test(waves, values, chunk_len=None, max_memory=DEFAULT_MAX_MEMORY):
+    """ Do a t_test for every value of a byte, each value against the rest
+
+    Equivalent to a t_test between :code:`waves[values == val]` and :code:`waves[values != val]` for
+    val in 0..255, but done in a single pass that accumulates the count, sum and sum of squares of
+    the traces for each value. All 256 t_tests are calculated from these.
+
+    As in :func:`t_test` and :func:`specific_t_test`, each group is split into halves by its own
+    traces: the first half of the traces with the value against the first half of the rest.
+
+    Args:
+        waves (np.array): Trace waves, shape (N, samples)
+        values (np.array): Byte value for each trace, shape (N,). Can also be (N, B)
+                            to test B bytes at once, which uses B times the memory.
+        chunk_len (int): Number of traces to process at once. If None, picked from max_memory
+        max_memory (int): Memory budget in bytes for each chunk of waves
+
+    Returns:
+        (numpy.array, numpy.array): t_test results of shape (256, 2, samples) (or (B, 256, 2, samples))
+        and the largest |t| for each value (shape (256,) or (B, 256)) where both halves are
+        past the same side of 0. A test fails :func:`check_t_test` if this is over the threshold.
+    """
+    values = np.asarray(values, dtype=np.uint8)
+    single = values.ndim == 1
+    if single:
+        values = values[:, np.newaxis]
+    sums = _byte_value_sums(waves, values, chunk_len, max_memory)
+
+    n_bytes = values.shape[1]
+    t = np.empty((n_bytes, 256, 2, waves.shape[1]), dtype='float64')
+    max_t = np.empty((n_bytes, 256), dtype='float64')
+    for b in range(n_bytes):
+        t[b] = _byte_value_t(*(x[b] for x in sums))
+        max_t[b] = _confirmed_max_t(t[b])
+    if single:
+        return t[0], max_t[0]
+    return t, max_t
+
+#: Rows of samples float64s accumulated for each byte by byte_value_t_test and eval_byte_values
+_BYTE_VALUE_ROWS = 2 * (2*256 + 2*256 + 1)
+
+def _add_by_key(sums, sq_sums, keys, c, c_sq):
+    # sums[k] += sum of the rows of c with key k (and the same for squares)
+    # sort the traces by key so each key's traces can be summed with reduceat
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    present = sorted_keys[starts]
+    sums[present] += np.add.reduceat(c[order], starts, axis=0)
+    sq_sums[present] += np.add.reduceat(c_sq[order], starts, axis=0)
+
+def _byte_value_split(v):
+    # how byte values v (shape (N,)) split into halves, like specific_t_test. Returns the traces
+    # in the second half of their value's traces, each value's count, and for each value u
+    # the trace index where the first half of the traces with other values ends
+    n_traces = len(v)
+    counts = np.bincount(v, minlength=256)
+    order = np.argsort(v, kind='stable')
+    rank = np.empty(n_traces, dtype='int64')
+    rank[order] = np.arange(n_traces) - np.repeat(np.cumsum(counts) - counts, counts)
+    second_half = rank >= (counts // 2)[v]
+
+    # the first (N - n_u)//2 traces without value u end after that many of them plus the
+    # traces with value u that come before them, which have fewer other traces ahead of them
+    rest_half = (n_traces - counts) // 2
+    others_before = np.arange(n_traces) - rank
+    bounds = rest_half + np.bincount(v, weights=others_before < rest_half[v], minlength=256).astype('int64')
+    return second_half, counts, bounds
+
+def _byte_value_sums(waves, values, chunk_len, max_memory):
+    # sums needed by _byte_value_t for each byte, values shape (N, B). For every byte:
+    # the sums of each half of each value's traces, the sums of the first half of the
+    # rest of the traces for each value, and the sums of every trace
+    n_traces, n_bytes = values.shape
+    trace_len = waves.shape[1]
+    shift = np.array(waves[0], dtype='float64')
+    splits = [_byte_value_split(values[:, b]) for b in range(n_bytes)]
 
+    value_sums = np.zeros((n_bytes, 2, 2*256, trace_len), dtype='float64')
+    # (traces before bounds, traces with the value before bounds), sums and squares
+    bound_sums = np.zeros((n_bytes, 2, 2*256, trace_len), dtype='float64')
+    total = np.zeros((2, trace_len), dtype='float64')
+    for i, chunk in iter_chunks(waves, chunk_len, max_memory):
+        chunk = np.asarray(chunk, dtype='float64') - shift
+        c_sq = np.square(chunk)
+        idx = np.arange(i, i + len(chunk))
+        for b, (second_half, _, bounds) in enumerate(splits):
+            v = values[i:i+len(chunk), b]
+            _add_by_key(value_sums[b, 0], value_sums[b, 1], second_half[idx] * 256 + v, chunk, c_sq)
+
+            before = idx < bounds[v]
+            if before.any():
+                _add_by_key(bound_sums[b, 0, 256:], bound_sums[b, 1, 256:], v[before], chunk[before], c_sq[before])
+
+            # sums of every trace before each bound that's in this chunk
+            inside = np.flatnonzero((bounds > i) & (bounds <= i + len(chunk)))
+            if len(inside):
+                ends, where = np.unique(bounds[inside] - i, return_inverse=True)
+                starts = np.r_[0, ends[:-1]]
+                for k, c in enumerate((chunk, c_sq)):
+                    partial = np.cumsum(np.add.reduceat(c[:ends[-1]], starts, axis=0), axis=0)
+                    bound_sums[b, k, inside] = total[k] + partial[where]
+        total[0] += np.sum(chunk, axis=0)
+        total[1] += np.sum(c_sq, axis=0)
+
+    # first half of the rest: traces before the bound that don't have the value
+    bound_sums[:, :, :256] -= bound_sums[:, :, 256:]
+    counts = np.array([split[1] for split in splits])
+    totals = np.broadcast_to(total, (n_bytes, 2, trace_len))
+    return (counts, np.full(n_bytes, n_traces), value_sums[:, 0].reshape(n_bytes, 2, 256, trace_len),
+            value_sums[:, 1].reshape(n_bytes, 2, 256, trace_len), bound_sums[:, 0, :256], bound_sums[:, 1, :256],
+            totals[:, 0], totals[:, 1])
+
+def _byte_value_t(counts, n_traces, sums, sq_sums, rest_sums, rest_sq_sums, total, total_sq):
+    # t for one byte, one half at a time so only a few (256, samples) temporaries are alive
+    # at once. sums are (2, 256, samples) for each half of each value's traces, rest_sums
+    # (256, samples) for the first half of the other traces. Returns (256, 2, samples)
+    n1 = np.stack([counts // 2, counts - counts // 2])[..., np.newaxis]
+    rest = n_traces - counts
+    n2 = np.stack([rest // 2, rest - rest // 2])[..., np.newaxis]
+    t = np.empty((256, 2, sums.shape[-1]), dtype='float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for half in range(2):
+            s1, q1 = sums[half], sq_sums[half]
+            if half == 0:
+                s2, q2 = rest_sums.copy(), rest_sq_sums.copy()
+            else:
+                # second half of the rest is everything else
+                s2 = total - sums[0] - sums[1] - rest_sums
+                q2 = total_sq - sq_sums[0] - sq_sums[1] - rest_sq_sums
+            mean1 = s1 / n1[half]
+            mean2 = s2 / n2[half]
+            # var1 / n1 and var2 / n2, reusing the temporaries
+            q1 = (q1 - s1 * mean1) / ((n1[half] - 1) * n1[half])
+            q2 -= s2 * mean2
+            q2 /= (n2[half] - 1) * n2[half]
+            mean1 -= mean2
+            q1 += q2
+            np.sqrt(q1, out=q1)
+            t[:, half] = mean1 / q1
+    return t
+
+def _confirmed_max_t(t):
+    # largest |t| where both halves are past the same side of 0, for t of shape (..., 2, samples)
+    same_side = np.sign(t[..., 0, :]) == np.sign(t[..., 1, :])
+    confirmed = np.where(same_side, np.fmin(np.abs(t[..., 0, :]), np.abs(t[..., 1, :])), 0)
+    return np.max(np.nan_to_num(confirmed), axis=-1)
+
+def eval_byte_values(waves, textins, func, key_len=16, round_range=None, byte_range=None, chunk_len=None,
+                        max_memory=DEFAULT_MAX_MEMORY, cache=None):
+    """ Evaluate rand_v_rand traces for every value of a byte leakage function.
+
+    Does the same tests as :func:`eval_rand_v_rand` with a byte leakage function and
+    :code:`bit_range=range(256)`, but with :func:`byte_value_t_test` doing all 256 values
+    for every byte in byte_range in one pass per round.
+
+    Args:
+        waves (np.array): Rand V Rand Trace waves
+        textins (np.array): Rand V Rand plaintexts
+        func (function): Byte leakage function from :func:`construct_leakage_byte`
+        key_len (int): length of key used in bytes
+        round_range (iterable): Rounds to test
+        byte_range (iterable): Bytes to test. Each byte's sums take about 2048*8*samples bytes of memory,
+                                so the bytes are done in blocks that fit in max_memory, reading
+                                waves once per block.
+        chunk_len (int): Number of traces to process at once. If None, picked from max_memory
+        max_memory (int): Memory budget in bytes for each chunk of waves, and for the sums of
+                            each block of bytes
+        cache (LeakageCache): Optional cache for the intermediate states
+
+    Returns:
+        (numpy.array, list): Largest confirmed |t| for each value, shape (rounds, bytes, 256), and
+        the (round, byte) of each row
+    """
+    value_func = getattr(func, "value_func", None)
+    if value_func is None:
+        raise ValueError("func must be a byte leakage function from construct_leakage_byte()")
+    round_range, byte_range, _ = _rand_v_rand_ranges(key_len, round_range, byte_range, None)
+    states = _cached_aes_states(textins[:len(waves)], FixedVRandomText(key_len)._K_dev, cache)
+
+    # the sums for each byte take _BYTE_VALUE_ROWS*8*samples bytes, so do as many bytes per pass as fit
+    byte_block = max(1, int(max_memory // (_BYTE_VALUE_ROWS * 8 * max(waves.shape[1], 1))))
+    byte_range = list(byte_range)
+    max_t = np.zeros((len(round_range), len(byte_range), 256), dtype='float64')
+    tests = []
+    for r, rnd in enumerate(round_range):
+        for b0 in range(0, len(byte_range), byte_block):
+            block = byte_range[b0:b0 + byte_block]
+            values = np.stack([value_func(states, byte, rnd) for byte in block], axis=1).astype(np.uint8)
+            sums = _byte_value_sums(waves, values, chunk_len, max_memory)
+            for b in range(len(block)):
+                max_t[r, b0 + b] = _confirmed_max_t(_byte_value_t(*(x[b] for x in sums)))
+            del sums
+        tests.append([(rnd, byte) for byte in byte_range])
+    return max_t, tests
+
+def t_test_fail_mask(t, threshold=4.5):
+    """Find the points where t_test results failed.
+
+    Args:
+        t (np.array): t_test results, shape (2, samples), or (K, 2, samples) for K tests
+        threshold (float): If t[0] and t[1] are above threshold or below -threshold at
+                            the same point, it is considered a failure point
+
+    Returns:
+        numpy.array: bool array of shape (samples,) or (K, samples), True at failure points
+    """
+    t = np.asarray(t)
+    t0, t1 = t[..., 0, :], t[..., 1, :]
+    return ((t0 > threshold) & (t1 > threshold)) | ((t0 < -threshold) & (t1 < -threshold))
 
 def check_t_test(t, threshold=4.5):
     """Check the results of the t_test and return points where it failed.
 
     Args:
-        t (np.array(shape=(2, scope.adc.samples), dtype='float64')): t_test results
+        t (np.array(shape=(2, scope.adc.samples), dtype='float64')): t_test results. Can also
+                            be shape (K, 2, samples) for K tests, like from :func:`specific_t_test`
         threshold (float): If t[0] and t[1] are above threshold or below -threshold at
                             the same point, it is considered a failure point
 
     Returns:
-        list of failed points
+        list of failed points, or a list of failed points for each test
+    """
+    fail = t_test_fail_mask(t, threshold)
+    if fail.ndim == 1:
+        return np.flatnonzero(fail).tolist()
+    return [np.flatnonzero(f).tolist() for f in fail]
+
+def passed_t_test(t, threshold=4.5):
+    """Check whether t_test results passed
+
+    Args:
+        t (np.array): t_test results, shape (2, samples), or (K, 2, samples) for K tests
+        threshold (float): Same as :func:`check_t_test`
+
+    Returns:
+        bool, or numpy.array of bools with shape (K,): True for tests with no failure points
+    """
+    return ~np.any(t_test_fail_mask(t, threshold), axis=-1)
+
+class FailRegions(namedtuple("FailRegions", ["test", "start", "stop", "peak"])):
+    """Contiguous runs of failure points, one entry per region in each array
+
+    Attributes:
+        test (numpy.array): Which test the region is in (always 0 for a single t_test)
+        start (numpy.array): First failure point in the region
+        stop (numpy.array): One past the last failure point in the region
+        peak (numpy.array): Largest |t| in either half of the t_test within the region
+    """
+    __slots__ = ()
+
+def fail_regions(t, threshold=4.5):
+    """Find contiguous regions of failure points in t_test results
+
+    Args:
+        t (np.array): t_test results, shape (2, samples), or (K, 2, samples) for K tests
+        threshold (float): Same as :func:`check_t_test`
+
+    Returns:
+        FailRegions: Arrays of the test, start, stop, and peak |t| of each region, ordered by
+        test and then start
     """
-    failed_points = []
-    for i in range(len(t[0])):
-        if ((t[0][i]) > threshold) and ((t[1][i]) > threshold):
-            failed_points.append(i)
-        elif ((t[0][i]) < -threshold) and ((t[1][i]) < -threshold):
-            failed_points.append(i)
+    t = np.asarray(t)
+    if t.ndim == 2:
+        t = t[np.newaxis]
+    fail = t_test_fail_mask(t, threshold)
+    n_tests, trace_len = fail.shape
 
-    return failed_points
+    # pad each test with a non-failing point on both sides so regions can't join across tests
+    padded = np.zeros((n_tests, trace_len + 2), dtype=np.int8)
+    padded[:, 1:-1] = fail
+    edges = np.diff(padded.ravel())
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1)
+
+    if len(starts) == 0:
+        empty = np.zeros(0, dtype='int64')
+        return FailRegions(empty, empty, empty, np.zeros(0, dtype='float64'))
+
+    abs_t = np.zeros((n_tests, trace_len + 2), dtype='float64')
+    abs_t[:, 1:-1] = np.max(np.abs(t), axis=1)
+    # reduceat over [start0, stop0, start1, stop1, ...], only the [start, stop) parts are used
+    peak = np.maximum.reduceat(abs_t.ravel(), np.stack([starts + 1, stops + 1], axis=1).ravel())[0::2]
+
+    test = starts // (trace_len + 2)
+    start = starts % (trace_len + 2)
+    stop = stops % (trace_len + 2)
+    return FailRegions(test, start, stop, peak)
+
+class TVLAResult:
+    """ Result of a single TVLA t_test
+
+    Usually taken from a :class:`TVLAResultSet`.
+
+    Attributes:
+        t (numpy.array): t_test results, shape (2, samples)
+        n_traces (tuple): Number of traces in group 1 and group 2
+        test (tuple): (round, byte, bit) of a specific test. None for entries that don't apply
+        label (str): Name of the test, e.g. the KTP used for a non-specific test
+        leakage_model (str): Description of the leakage function used
+        threshold (float): Threshold for :func:`check_t_test`
+    """
+    def __init__(self, t, n_traces, test=(None, None, None), label="", leakage_model="", threshold=4.5):
+        self.t = t
+        self.n_traces = tuple(int(n) for n in n_traces)
+        self.test = tuple(test)
+        self.label = label
+        self.leakage_model = leakage_model
+        self.threshold = threshold
+
+    @property
+    def round(self):
+        return self.test[0]
+
+    @property
+    def byte(self):
+        return self.test[1]
+
+    @property
+    def bit(self):
+        return self.test[2]
+
+    @property
+    def passed(self):
+        """ True if the test has no failure points """
+        return bool(passed_t_test(self.t, self.threshold))
+
+    @property
+    def fail_points(self):
+        """ Failure points, same as :func:`check_t_test` """
+        return check_t_test(self.t, self.threshold)
+
+    @property
+    def fail_regions(self):
+        """ Failure regions, same as :func:`fail_regions` """
+        return fail_regions(self.t, self.threshold)
+
+    def __repr__(self):
+        return "TVLAResult(label={!r}, test={}, n_traces={}, passed={})".format(self.label, self.test, self.n_traces, self.passed)
+
+
+class TVLAResultSet:
+    """ Results of a set of TVLA t_tests, stored as one (K, 2, samples) array
+
+    Can be saved in bulk to a .npz file or zarr group (for example next to the traces)
+    and loaded again later without redoing the t_tests.
+
+    Usage::
+
+        results = cwtvla.eval_rand_v_rand_batch(waves, textins, cwtvla.sbox_hw)
+        print(results.passed)
+        for result in results:
+            if not result.passed:
+                print(result.test, result.fail_regions)
+        results.save_zarr(zarr.open_group("data/CWData.zarr/platform/RandVRand-16/results/sbox_hw"))
+
+    Args:
+        t (numpy.array): t_test results, shape (K, 2, samples)
+        n_traces (numpy.array): Number of traces in group 1 and group 2 for each test, shape (K, 2)
+        tests (list): (round, byte, bit) for each test. Use None for entries that don't apply
+        labels (list): Name of each test
+        leakage_model (str): Description of the leakage function used
+        threshold (float): Threshold for :func:`check_t_test`
+    """
+    def __init__(self, t, n_traces, tests=None, labels=None, leakage_model="", threshold=4.5):
+        self.t = np.asarray(t)
+        n_tests = len(self.t)
+        self.n_traces = np.array(n_traces, dtype='int64').reshape(n_tests, 2)
+        if tests is None:
+            tests = [(None, None, None)] * n_tests
+        self.tests = [tuple(test) for test in tests]
+        if labels is None:
+            labels = [""] * n_tests
+        self.labels = list(labels)
+        self.leakage_model = leakage_model
+        self.threshold = threshold
+
+    def __len__(self):
+        return len(self.t)
+
+    def __getitem__(self, k):
+        return TVLAResult(self.t[k], self.n_traces[k], self.tests[k], self.labels[k], self.leakage_model, self.threshold)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    @classmethod
+    def from_results(cls, results):
+        """ Combine a list of TVLAResults with the same leakage model and threshold
+
+        Args:
+            results (list): TVLAResults to combine
+
+        Returns:
+            TVLAResultSet
+        """
+        return cls(np.array([r.t for r in results]), [r.n_traces for r in results], [r.test for r in results],
+                    [r.label for r in results], results[0].leakage_model, results[0].threshold)
+
+    @property
+    def passed(self):
+        """ numpy.array of bools, True for each test with no failure points """
+        return passed_t_test(self.t, self.threshold)
+
+    def fail_regions(self):
+        """ Failure regions for every test, same as :func:`fail_regions` """
+        return fail_regions(self.t, self.threshold)
+
+    def _to_arrays(self):
+        tests = np.array([[-1 if x is None else x for x in test] for test in self.tests], dtype='int64').reshape(-1, 3)
+        return {
+            "t": self.t,
+            "n_traces": self.n_traces,
+            "tests": tests,
+            "labels": np.array(self.labels, dtype='U'),
+        }
+
+    @classmethod
+    def _from_arrays(cls, arrays, leakage_model, threshold):
+        tests = [tuple(None if x < 0 else int(x) for x in test) for test in arrays["tests"]]
+        return cls(arrays["t"], arrays["n_traces"], tests, [str(l) for l in arrays["labels"]],
+                    leakage_model, threshold)
+
+    def save(self, file):
+        """ Save the results to a .npz file
+
+        Args:
+            file (str or file): Passed to numpy.savez_compressed
+        """
+        np.savez_compressed(file, leakage_model=self.leakage_model, threshold=self.threshold, **self._to_arrays())
+
+    @classmethod
+    def load(cls, file):
+        """ Load results saved with :code:`save()`
+
+        Args:
+            file (str or file): Passed to numpy.load
+
+        Returns:
+            TVLAResultSet
+        """
+        with np.load(file) as arrays:
+            return cls._from_arrays(arrays, str(arrays["leakage_model"]), float(arrays["threshold"]))
+
+    def save_zarr(self, group):
+        """ Save the results into a zarr group
+
+        Args:
+            group (zarr.Group): Group to store the results in. Existing results are overwritten.
+        """
+        for name, arr in self._to_arrays().items():
+            group.array(name, arr, overwrite=True)
+        group.attrs["leakage_model"] = self.leakage_model
+        group.attrs["threshold"] = self.threshold
+
+    @classmethod
+    def load_zarr(cls, group):
+        """ Load results saved with :code:`save_zarr()`
+
+        Args:
+            group (zarr.Group): Group the results were saved in
+
+        Returns:
+            TVLAResultSet
+        """
+        arrays = {name: group[name][...] for name in ("t", "n_traces", "tests", "labels")}
+        return cls._from_arrays(arrays, group.attrs["leakage_model"], group.attrs["threshold"])
+
+    def save_store(self, store, name):
+        """ Save the results into a :class:`cwtvla.trace_store.TraceStore`
+
+        Args:
+            store (TraceStore): Store to save the results in
+            name (str): Group name for the results. Existing results are overwritten.
+        """
+        for array_name, arr in self._to_arrays().items():
+            store.write("{}/{}".format(name, array_name), arr)
+        store.set_attrs(name, leakage_model=self.leakage_model, threshold=self.threshold)
+
+    @classmethod
+    def load_store(cls, store, name):
+        """ Load results saved with :code:`save_store()`
+
+        Args:
+            store (TraceStore): Store the results were saved in
+            name (str): Group name the results were saved under
+
+        Returns:
+            TVLAResultSet
+        """
+        arrays = {array_name: store.read("{}/{}".format(name, array_name))
+                    for array_name in ("t", "n_traces", "tests", "labels")}
+        attrs = store.attrs(name)
+        return cls._from_arrays(arrays, attrs["leakage_model"], attrs["threshold"])
+
+    def __repr__(self):
+        return "TVLAResultSet({} tests, {} passed, leakage_model={!r})".format(len(self), int(np.sum(self.passed)), self.leakage_model)
 
 def build_mean_corr(traces):
+    """ Subtract the mean trace from traces
+
+    Makes a full copy of traces. Use :func:`higher_order_t_test` to avoid this.
+
+    Args:
+        traces (numpy.array): Traces to centre
+
+    Returns:
+        numpy.array: Mean centred traces
+    """
     mean = np.mean(traces, axis=0)
-    print(len(mean))
     return traces-mean
 
-def build_centered_product(mct):
-    return np.multiply(mct, axis=1)
+def build_centered_product(mct, order=2):
+    """ Combine mean centred traces for a univariate higher order test
+
+    Makes a full copy of mct. Use :func:`higher_order_t_test` to avoid this.
+
+    Args:
+        mct (numpy.array): Mean centred traces from :func:`build_mean_corr`
+        order (int): Order of the test
+
+    Returns:
+        numpy.array: Centred product of each sample with itself
+    """
+    return np.power(mct, order)
 
 sbox_hw = construct_leakage_bit("subbytes", None)
 roundout_hw = construct_leakage_bit("addroundkey", None)
@@ -0,0 +1,157 @@
+"""
+On disk cache for leakage model labels.
+
+Calculating every intermediate AES state and the selector matrices built from them
+has to be redone each time a Random V Random dataset is analysed. The analysis
+functions take a :class:`LeakageCache` to keep these on disk between runs, keyed by a
+hash of the plaintexts, key, and leakage model, so repeated analyses of the same
+dataset skip straight to the t-tests.
+"""
+import contextlib
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+#: Default maximum size (in bytes) of everything stored in a cache directory
+DEFAULT_MAX_SIZE = 2 * 1024**3
+
+@contextlib.contextmanager
+def atomic_write(filename, mode="wb"):
+    """ Open a temporary file to write, which replaces filename once it's closed
+
+    An interrupted write never leaves a broken or half written filename behind.
+
+    Usage::
+
+        with atomic_write("data/meta.json", "w") as f:
+            json.dump(meta, f)
+
+    Args:
+        filename (str): File to write
+        mode (str): "wb" or "w"
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def fingerprint(*parts):
+    """ Hash arrays, bytes, and strings into a cache key
+
+    Arrays are hashed with their dtype and shape, so the same bytes in a different
+    shape give a different key.
+
+    Returns:
+        str: Hex digest
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update("{}{}".format(part.dtype.str, part.shape).encode())
+            h.update(np.ascontiguousarray(part).data)
+        elif isinstance(part, (bytes, bytearray)):
+            h.update(bytes(part))
+        else:
+            h.update(repr(part).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+class LeakageCache:
+    """ Size bounded on disk cache of arrays, such as AES states and selector matrices
+
+    Arrays are stored as .npy files in path and loaded memory mapped. When the files
+    take up more than max_size bytes, the least recently used ones are removed.
+
+    Usage::
+
+        cache = cwtvla.LeakageCache("data/leakage_cache")
+        # computes the states and selectors the first time, loads them afterwards
+        results = cwtvla.eval_rand_v_rand_batch(waves, textins, func, cache=cache)
+
+    Args:
+        path (str): Directory to store the cache in. Created if it doesn't exist.
+        max_size (int): Maximum size of the cache in bytes
+    """
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".npy")
+
+    def get(self, key):
+        """ Load the array stored under key
+
+        Args:
+            key (str): Key from :func:`fingerprint`
+
+        Returns:
+            numpy.array: Read only memory mapped array, or None if key isn't in the cache
+        """
+        filename = self._file(key)
+        try:
+            array = np.load(filename, mmap_mode='r')
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        # mark as recently used
+        os.utime(filename)
+        return array
+
+    def put(self, key, array):
+        """ Store array under key, then evict old entries if the cache is too big
+
+        Arrays bigger than max_size aren't stored.
+
+        Args:
+            key (str): Key from :func:`fingerprint`
+            array (numpy.array): Array to store
+        """
+        array = np.asarray(array)
+        if array.nbytes > self.max_size:
+            return
+        with atomic_write(self._file(key)) as f:
+            np.save(f, array)
+        self._evict()
+
+    def get_or_compute(self, key, compute):
+        """ Load the array stored under key, or compute and store it if it isn't there
+
+        Args:
+            key (str): Key from :func:`fingerprint`
+            compute (function()): Returns the array if it isn't cached
+
+        Returns:
+            numpy.array: The cached or computed array
+        """
+        array = self.get(key)
+        if array is None:
+            array = compute()
+            self.put(key, array)
+        return array
+
+    def size(self):
+        """ Total size of the cached arrays in bytes """
+        return sum(os.path.getsize(f) for f in self._entries())
+
+    def clear(self):
+        """ Remove every cached array """
+        for f in self._entries():
+            os.remove(f)
+
+    def _entries(self):
+        return [os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith(".npy")]
+
+    def _evict(self):
+        entries = [(os.path.getmtime(f), os.path.getsize(f), f) for f in self._entries()]
+        total = sum(size for _, size, _ in entries)
+        for _, size, f in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(f)
+            total -= size
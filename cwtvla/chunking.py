@@ -0,0 +1,361 @@
+"""
+Helpers for processing trace arrays that don't fit in memory.
+
+Trace arrays can be in memory numpy arrays or anything that supports numpy
+style row slicing, such as zarr arrays, h5py datasets, or np.memmap. Out of core
+arrays are read a chunk of rows at a time, with reads lined up with the array's
+stored chunks where possible. :class:`BufferedTraceWriter` does the same for
+writing traces as they're captured.
+
+:func:`trace_chunks` and :func:`default_compressor` pick the zarr layout used for
+new trace arrays, and :func:`rechunk` / :func:`rechunk_zarr` convert existing
+arrays to it. examples/rechunk_zarr.py does this for a whole zarr store::
+
+    python examples/rechunk_zarr.py data/CWData.zarr data/CWData-rechunked.zarr
+"""
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+import numpy as np
+
+#: Default memory budget (in bytes) for the chunks being processed at once
+DEFAULT_MAX_MEMORY = 256 * 1024**2
+
+#: Default size (in bytes, before compression) of each stored chunk of a trace array
+DEFAULT_CHUNK_BYTES = 8 * 1024**2
+
+#: Widest a stored chunk gets along the sample axis
+DEFAULT_MAX_CHUNK_SAMPLES = 4096
+
+def in_memory(array):
+    """ Check if array is a regular in memory numpy array (not a memmap) """
+    return isinstance(array, np.ndarray) and not isinstance(array, np.memmap)
+
+def stored_chunk_len(array):
+    """ Number of rows in each of array's stored chunks, or None if it isn't chunked """
+    chunks = getattr(array, "chunks", None)
+    if chunks:
+        return chunks[0]
+    return None
+
+def trace_chunks(shape, dtype, chunk_bytes=DEFAULT_CHUNK_BYTES, max_samples=DEFAULT_MAX_CHUNK_SAMPLES):
+    """ Pick a stored chunk shape for a trace array
+
+    Long traces are split into equal width tiles of at most max_samples, so a window of
+    samples can be read without reading whole traces. The number of rows is then picked
+    so each chunk is about chunk_bytes.
+
+    Args:
+        shape (tuple): (N, samples) shape of the array
+        dtype (numpy.dtype): Array dtype
+        chunk_bytes (int): Target uncompressed chunk size in bytes
+        max_samples (int): Maximum chunk width along the sample axis
+
+    Returns:
+        (int, int): Rows and samples per chunk
+    """
+    n_traces, n_samples = shape
+    n_tiles = -(-n_samples // max_samples)
+    samples = max(1, -(-n_samples // max(n_tiles, 1)))
+    rows = max(1, chunk_bytes // (samples * np.dtype(dtype).itemsize))
+    return int(min(rows, max(n_traces, 1))), int(samples)
+
+def default_compressor(dtype=None):
+    """ Compressor for new trace arrays: Blosc zstd with byte shuffle
+
+    Byte shuffling groups the high (mostly constant) and low bytes of each sample, which
+    compresses ADC traces much better than plain zstd. Needs numcodecs (installed with zarr).
+
+    Args:
+        dtype (numpy.dtype): Array dtype. Single byte arrays use bit shuffle instead.
+
+    Returns:
+        numcodecs.Blosc
+    """
+    from numcodecs import Blosc
+    shuffle = Blosc.BITSHUFFLE if dtype is not None and np.dtype(dtype).itemsize == 1 else Blosc.SHUFFLE
+    return Blosc(cname="zstd", clevel=3, shuffle=shuffle)
+
+def rechunk(source, dest, max_memory=DEFAULT_MAX_MEMORY):
+    """ Copy source into dest a block of rows at a time
+
+    dest should already be created with the new chunk shape and compressor. Reads
+    are lined up with dest's stored chunks, so each dest chunk is written once.
+
+    Args:
+        source (array like): Array to copy
+        dest (array like): Array to copy into, same shape as source
+        max_memory (int): Memory budget in bytes
+    """
+    if source.shape != dest.shape:
+        raise ValueError("Shapes don't match: {} and {}".format(source.shape, dest.shape))
+    if len(source) == 0:
+        return
+    chunk_len = choose_chunk_len(source, max_memory)
+    stored = stored_chunk_len(dest)
+    if stored:
+        chunk_len = max(stored, chunk_len // stored * stored)
+    for start, chunk in iter_chunks(source, chunk_len):
+        dest[start:start + len(chunk)] = chunk
+
+def rechunk_zarr(source, dest, chunk_bytes=DEFAULT_CHUNK_BYTES, max_samples=DEFAULT_MAX_CHUNK_SAMPLES,
+                    compressor="default", max_memory=DEFAULT_MAX_MEMORY):
+    """ Rechunk every array in a zarr group (e.g. data/CWData.zarr) into a new group
+
+    2D arrays with more than 16 columns (traces) get chunks from :func:`trace_chunks`,
+    other arrays (plaintexts, results, ...) are chunked along rows only. Attributes
+    are copied. Works out of core, using about max_memory bytes.
+
+    Args:
+        source (str or zarr.Group): Group to read
+        dest (str or zarr.Group): Group to write. Existing arrays are overwritten.
+        chunk_bytes (int): Target uncompressed chunk size for trace arrays
+        max_samples (int): Maximum chunk width along the sample axis for trace arrays
+        compressor: numcodecs compressor, None for no compression, or "default" for
+                    :func:`default_compressor`
+        max_memory (int): Memory budget in bytes
+    """
+    import zarr
+    if isinstance(source, str):
+        source = zarr.open_group(source, mode='r')
+    if isinstance(dest, str):
+        dest = zarr.open_group(dest, mode='a')
+    dest.attrs.update(source.attrs.asdict())
+
+    for name, array in source.arrays():
+        if array.ndim == 2 and array.shape[1] > 16:
+            chunks = trace_chunks(array.shape, array.dtype, chunk_bytes, max_samples)
+        elif array.ndim > 0:
+            chunks = (trace_chunks((len(array), int(np.prod(array.shape[1:], dtype='int64')) or 1),
+                                    array.dtype, chunk_bytes, max_samples)[0],) + tuple(array.shape[1:])
+        else:
+            chunks = True
+        comp = default_compressor(array.dtype) if compressor == "default" else compressor
+        new = dest.zeros(name, shape=array.shape, chunks=chunks, dtype=array.dtype,
+                         compressor=comp, overwrite=True)
+        if array.ndim == 0:
+            new[...] = array[...]
+        else:
+            rechunk(array, new, max_memory)
+        new.attrs.update(array.attrs.asdict())
+
+    for name, group in source.groups():
+        rechunk_zarr(group, dest.require_group(name), chunk_bytes, max_samples, compressor, max_memory)
+
+def is_integer(array):
+    """ Check if array holds integer traces, like raw ADC codes """
+    return np.issubdtype(array.dtype, np.integer)
+
+def choose_chunk_len(array, max_memory=DEFAULT_MAX_MEMORY):
+    """ Pick how many rows of array to process at once
+
+    Allows for the chunk being processed, the next chunk being prefetched, and
+    a float64 working copy to fit in max_memory. Rounded down to a multiple of the
+    array's stored chunk length if at least one stored chunk fits.
+
+    Args:
+        array (array like): Trace array, shape (N, samples)
+        max_memory (int): Memory budget in bytes
+
+    Returns:
+        int: Number of rows per chunk
+    """
+    row_bytes = int(np.prod(array.shape[1:], dtype='int64')) * 8
+    rows = max(1, int(max_memory // (3 * max(row_bytes, 1))))
+    stored = stored_chunk_len(array)
+    if stored and rows >= stored:
+        rows = rows // stored * stored
+    return rows
+
+def iter_chunks(array, chunk_len=None, max_memory=DEFAULT_MAX_MEMORY, prefetch=True):
+    """ Iterate over array a chunk of rows at a time
+
+    In memory arrays are returned as views. Other arrays are read into memory a chunk
+    at a time, with the next chunk read on a background thread while the current one
+    is being processed if prefetch is True.
+
+    Usage::
+
+        for start, chunk in iter_chunks(zarr_group.traces.waves):
+            acc.update(0, chunk)
+
+    Args:
+        array (array like): Array to iterate over
+        chunk_len (int): Number of rows in each chunk. If None, picked with :func:`choose_chunk_len`
+        max_memory (int): Memory budget in bytes, used if chunk_len is None
+        prefetch (bool): Read the next chunk in the background
+
+    Yields:
+        (int, numpy.array): Index of the first row of the chunk, and the chunk
+    """
+    if chunk_len is None:
+        chunk_len = choose_chunk_len(array, max_memory)
+    starts = range(0, len(array), chunk_len)
+
+    if in_memory(array):
+        for i in starts:
+            yield i, array[i:i+chunk_len]
+        return
+
+    def read(i):
+        return np.array(array[i:i+chunk_len])
+
+    if not prefetch or len(starts) < 2:
+        for i in starts:
+            yield i, read(i)
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(read, starts[0])
+        for k, i in enumerate(starts):
+            chunk = future.result()
+            if k + 1 < len(starts):
+                future = pool.submit(read, starts[k + 1])
+            yield i, chunk
+
+def drop_rows(chunks, rows):
+    """ Remove rows from chunks yielded by :func:`iter_chunks`
+
+    Used to leave out traces that failed verification without loading the whole array.
+
+    Args:
+        chunks (iterable): (start, chunk) pairs from :func:`iter_chunks`
+        rows (list): Indices of the rows to remove
+
+    Yields:
+        (int, numpy.array): Index of the first row of the chunk once rows are removed, and the chunk
+    """
+    rows = np.unique(np.asarray(rows, dtype='int64'))
+    for start, chunk in chunks:
+        drop = rows[(rows >= start) & (rows < start + len(chunk))] - start
+        yield start - np.searchsorted(rows, start), np.delete(chunk, drop, axis=0)
+
+class BufferedTraceWriter:
+    """ Write rows to an array a chunk at a time on a background thread
+
+    Rows are set one at a time (e.g. as traces are captured) into a small ring of
+    preallocated chunk buffers. Once the rows move past a chunk, it's written to array on
+    a writer thread while the next chunk is filled. Memory use is bounded to n_buffers
+    chunks, and if the capture crashes only the chunks that haven't been written yet are lost.
+
+    Rows must be set in increasing chunk order, but can be in any order within a chunk.
+    Rows that aren't set between the first and last row set in a chunk are written as zeros.
+
+    Usage::
+
+        with BufferedTraceWriter(zarr_group.traces.waves) as waves:
+            for i in range(N):
+                waves[i,:] = cw.capture_trace(scope, target, text, key).wave
+
+    Args:
+        array (array like): Array to write to, e.g. a zarr array, h5py dataset, or np.memmap
+        chunk_len (int): Rows per chunk. If None, uses the array's stored chunk length, or
+                            :func:`choose_chunk_len` if it isn't chunked
+        n_buffers (int): Number of chunk buffers. Capture blocks if all of them are waiting to be written.
+        on_write (function(int)): Optional callback, called on the writer thread with the row after the
+                            last row written each time a chunk is written, e.g. to record progress
+                            so an interrupted capture can be resumed
+    """
+    def __init__(self, array, chunk_len=None, n_buffers=3, on_write=None):
+        if n_buffers < 2:
+            raise ValueError("Need at least 2 buffers, got {}".format(n_buffers))
+        if chunk_len is None:
+            chunk_len = stored_chunk_len(array) or choose_chunk_len(array)
+        self.array = array
+        self.chunk_len = chunk_len
+        self.on_write = on_write
+        self._n_buffers = n_buffers
+        self._free = queue.Queue()
+        for _ in range(n_buffers):
+            self._free.put(np.zeros((chunk_len,) + tuple(array.shape[1:]), dtype=array.dtype))
+        self._pending = queue.Queue()
+        self._error = None
+        self._chunk = None
+        self._buf = None
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    def __len__(self):
+        return len(self.array)
+
+    def __setitem__(self, key, value):
+        row, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if not isinstance(row, (int, np.integer)):
+            raise TypeError("BufferedTraceWriter rows must be set one at a time")
+        if row < 0:
+            row += len(self.array)
+        if not 0 <= row < len(self.array):
+            raise IndexError("Row {} out of range for array with {} rows".format(row, len(self.array)))
+        self._check_error()
+
+        chunk = row // self.chunk_len
+        if chunk != self._chunk:
+            if self._chunk is not None and chunk < self._chunk:
+                raise ValueError("Row {} is in a chunk that's already been written".format(row))
+            self._submit()
+            self._chunk = chunk
+            self._buf = self._free.get()
+            self._buf[:] = 0
+            self._lo, self._hi = self.chunk_len, 0
+
+        i = row - chunk * self.chunk_len
+        self._buf[(i,) + rest] = value
+        self._lo, self._hi = min(self._lo, i), max(self._hi, i + 1)
+
+    def _submit(self):
+        # hand the current chunk to the writer thread
+        if self._buf is not None:
+            start = self._chunk * self.chunk_len
+            self._pending.put((self._buf, start + self._lo, start + self._hi, self._lo))
+            self._buf = None
+
+    def _write_loop(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            buf, start, stop, lo = item
+            try:
+                if self._error is None:
+                    self.array[start:stop] = buf[lo:lo + stop - start]
+                    if self.on_write is not None:
+                        self.on_write(stop)
+            except BaseException as e:
+                self._error = e
+            self._free.put(buf)
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def flush(self):
+        """ Write the rows set so far and wait for them to be written """
+        self._submit()
+        self._chunk = None
+        # every buffer is back in the free queue once the writer has caught up
+        buffers = [self._free.get() for _ in range(self._n_buffers)]
+        for buf in buffers:
+            self._free.put(buf)
+        self._check_error()
+
+    def close(self):
+        """ Write any remaining rows and stop the writer thread """
+        self._submit()
+        self._pending.put(None)
+        self._writer.join()
+        self._check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
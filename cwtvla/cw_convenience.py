@@ -1,10 +1,13 @@
+import functools
 import logging
+import threading
 try:
     import chipwhisperer as cw
-    import zarr
     from tqdm import trange
-    from .ktp import FixedVRandomText, FixedVRandomKey, SemiFixedVRandomText, verify_AES
-    from .analysis import t_test, check_t_test
+    from .ktp import FixedVRandomText, FixedVRandomKey, SemiFixedVRandomText, verify_AES, verify_AES_blocks, BulkVerifier
+    from .analysis import t_test, check_t_test, TVLAResult, TVLAResultSet
+    from .chunking import BufferedTraceWriter, DEFAULT_CHUNK_BYTES, trace_chunks
+    from .trace_store import default_trace_store, open_trace_store, trace_name
     import numpy as np
 
 
@@ -63,49 +66,118 @@ try:
 
         return scope,target
 
-    def capture_non_specific(scope, target, ktp_class, N=10000, key_len=16, group1=None, group2=None):
+    def _adc_dtype(as_int):
+        # raw ADC codes fit in 16 bits
+        return 'uint16' if as_int else 'float64'
+
+    def adc_scale(scope):
+        """ Scale and offset that convert the scope's raw ADC codes to the usual float traces
+
+        :code:`float_trace = scale * int_trace + offset`. These are stored in the "scale" and "offset"
+        attrs of integer trace arrays saved by :func:`capture_all`.
+
+        Args:
+            scope (CW scope object): Setup scope object
+
+        Returns:
+            (float, float): scale, offset
+        """
+        bits = getattr(scope.adc, "bits_per_sample", 10)
+        return 1 / 2**bits, -0.5
+
+    def _next_pairs(ktp, group, n):
+        # keys and texts of the next n pairs from group 0 (A) or 1 (B). KTPs without the
+        # *_batch methods (e.g. user written ones) are asked for one pair at a time
+        batch = getattr(ktp, "next_group_A_batch" if group == 0 else "next_group_B_batch", None)
+        if batch is not None:
+            return batch(n)
+        next_pair = ktp.next_group_A if group == 0 else ktp.next_group_B
+        pairs = [next_pair() for _ in range(n)]
+        return [key for key, _ in pairs], [text for _, text in pairs]
+
+    def _skip_pairs(ktp, groups, n):
+        # move ktp n pairs on from its current position in each of groups (0 for A, 1 for B)
+        if n <= 0:
+            return
+        if hasattr(ktp, "seek") and hasattr(ktp, "state"):
+            ktp.seek(ktp.state()["index"][groups[0]] + n)
+            return
+        for group in groups:
+            _next_pairs(ktp, group, n)
+
+    def capture_non_specific(scope, target, ktp_class, N=10000, key_len=16, group1=None, group2=None, start=0,
+                                defer_verify=False, textouts1=None, textouts2=None, as_int=False):
         """ Capture data for a non-specific TVLA t-test
 
+        By default each trace's ciphertext is checked as soon as it's captured, and a ValueError is
+        raised if it's wrong. With defer_verify=True, ciphertexts are recorded in textouts1/textouts2
+        and checked in bulk on a background thread instead, and the indices of bad traces are
+        returned so they can be masked out.
+
         Args:
             scope (CW scope object): Already setup scope object
             target (CW target object): Already setup target object
-            ktp_class (ktp): Non specific KTP object (FixedVRandText, Key, etc)
+            ktp_class (ktp): Non specific KTP class (FixedVRandText, Key, etc), or an already
+                                created KTP object, such as a :class:`cwtvla.ktp.KTPSequence`.
+                                Only next_group_A() and next_group_B() are needed; the
+                                *_batch methods and seek() are used if the KTP has them.
             N (int): Number of traces to capture for each dataset (will end up with 2*N traces total)
             key_len (int): 16 for AES-128, 32 for AES-256
             group1 (np.array): Optional array object for storing traces in
             group2 (np.array): Optional array object for storing traces in
+            start (int): Trace to start at, for resuming an interrupted capture into group1/group2.
+                            Pairs are taken from wherever ktp is when it's passed in (e.g. after
+                            :code:`seek()`), and the first start pairs are skipped, so trace i
+                            always gets the i-th pair from that position.
+            defer_verify (bool): Verify ciphertexts in bulk instead of after every trace
+            textouts1 (np.array): Optional array object for storing group1's ciphertexts in
+            textouts2 (np.array): Optional array object for storing group2's ciphertexts in
+            as_int (bool): Capture raw integer ADC codes instead of floats. Default group arrays are
+                            uint16 instead of float64. See :func:`adc_scale` for converting them.
 
         Returns:
-            group1, group2
+            group1, group2, or group1, group2, (bad1, bad2) if defer_verify is True, where
+            bad1 and bad2 are lists of the indices of traces that failed verification
         """
-        ktp = ktp_class(key_len)
+        ktp = ktp_class(key_len) if isinstance(ktp_class, type) else ktp_class
+        _skip_pairs(ktp, (0, 1), start)
         if group1 is None:
-            group1 = np.zeros((N, scope.adc.samples), dtype='float64')
+            group1 = np.zeros((N, scope.adc.samples), dtype=_adc_dtype(as_int))
         if group2 is None:
-            group2 = np.zeros((N, scope.adc.samples), dtype='float64')
-        for i in trange(N):
-            key, text = ktp.next_group_A()
+            group2 = np.zeros((N, scope.adc.samples), dtype=_adc_dtype(as_int))
+        capture_args = {"as_int": True} if as_int else {}
+        if defer_verify:
+            verifiers = (BulkVerifier(), BulkVerifier())
 
-            trace = cw.capture_trace(scope, target, text, key)
-            while trace is None:
-                trace = cw.capture_trace(scope, target, text, key)
+        # generate every key/text pair before starting
+        keys_A, texts_A = _next_pairs(ktp, 0, N - start)
+        keys_B, texts_B = _next_pairs(ktp, 1, N - start)
+        for i in trange(start, N):
+            for g, (keys, texts, group, textouts) in enumerate(((keys_A, texts_A, group1, textouts1),
+                                                                (keys_B, texts_B, group2, textouts2))):
+                key, text = bytearray(keys[i - start]), bytearray(texts[i - start])
 
-            if not verify_AES(text, key, trace.textout):
-                raise ValueError("Encryption failed")
-            group1[i,:] = trace.wave[:]
+                trace = cw.capture_trace(scope, target, text, key, **capture_args)
+                while trace is None:
+                    trace = cw.capture_trace(scope, target, text, key, **capture_args)
 
-            key, text = ktp.next_group_B() 
-            trace = cw.capture_trace(scope, target, text, key)
-            while trace is None:
-                trace = cw.capture_trace(scope, target, text, key)
-
-            group2[i,:] = trace.wave[:]
-            if not verify_AES(text, key, trace.textout):
-                raise ValueError("Encryption failed")
+                if textouts is not None and trace.textout is not None:
+                    textouts[i,:] = np.array(trace.textout)[:]
+                if defer_verify:
+                    verifiers[g].add(i, text, key, trace.textout)
+                elif not verify_AES(text, key, trace.textout):
+                    raise ValueError("Encryption failed")
+                group[i,:] = trace.wave[:]
 
+        if defer_verify:
+            bad = tuple(verifier.close() for verifier in verifiers)
+            if any(bad):
+                logging.warning("{} traces failed verification".format(sum(len(b) for b in bad)))
+            return group1, group2, bad
         return group1, group2
 
-    def capture_rand(scope, target, N=10000, key_len=16, waves=None, textins=None):
+    def capture_rand(scope, target, N=10000, key_len=16, waves=None, textins=None, start=0,
+                        defer_verify=False, textouts=None, as_int=False, ktp=FixedVRandomText):
         """ Capture traces for a rand_v_rand TVLA t-test
 
         Args:
@@ -115,82 +187,241 @@ try:
             key_len (int): 16 for AES-128, 32 for AES-256
             waves (np.array): Optional array object for storing traces in
             textins (np.array): Optional array object for storing plaintexts in
+            start (int): Trace to start at, for resuming an interrupted capture into waves/textins.
+                            Pairs are counted from ktp's position when it's passed in, see
+                            :func:`capture_non_specific`
+            defer_verify (bool): Verify ciphertexts in bulk on a background thread instead of
+                                    after every trace. See :func:`capture_non_specific`
+            textouts (np.array): Optional array object for storing ciphertexts in
+            as_int (bool): Capture raw integer ADC codes instead of floats, see :func:`capture_non_specific`
+            ktp (ktp): KTP class or already created KTP object, such as a :class:`cwtvla.ktp.KTPSequence`.
+                            Group B's key/text pairs are used. Only next_group_B() is needed,
+                            see :func:`capture_non_specific`
 
         Returns:
-            waves, textins
+            waves, textins, or waves, textins, bad if defer_verify is True, where bad is a
+            list of the indices of traces that failed verification
         """
-        ktp = FixedVRandomText(key_len)
+        ktp = ktp(key_len) if isinstance(ktp, type) else ktp
+        _skip_pairs(ktp, (1,), start)
         if waves is None:
-            waves = np.zeros((N, scope.adc.samples), dtype='float64')
+            waves = np.zeros((N, scope.adc.samples), dtype=_adc_dtype(as_int))
+        capture_args = {"as_int": True} if as_int else {}
         if textins is None:
             textins = np.zeros((N, 16), dtype='uint8')
-        for i in trange(N):
-            key, text = ktp.next_group_B()
-            trace = cw.capture_trace(scope, target, text, key)
+        if defer_verify:
+            verifier = BulkVerifier()
+        keys, texts = _next_pairs(ktp, 1, N - start)
+        for i in trange(start, N):
+            key, text = bytearray(keys[i - start]), bytearray(texts[i - start])
+            trace = cw.capture_trace(scope, target, text, key, **capture_args)
             while trace is None:
-                trace = cw.capture_trace(scope, target, text, key)
-            if not verify_AES(text, key, trace.textout):
+                trace = cw.capture_trace(scope, target, text, key, **capture_args)
+            if textouts is not None and trace.textout is not None:
+                textouts[i,:] = np.array(trace.textout)[:]
+            if defer_verify:
+                verifier.add(i, text, key, trace.textout)
+            elif not verify_AES(text, key, trace.textout):
                 raise ValueError("Encryption failed")
 
             waves[i,:] = trace.wave[:]
             textins[i,:] = np.array(text)[:]
 
+        if defer_verify:
+            bad = verifier.close()
+            if bad:
+                logging.warning("{} traces failed verification".format(len(bad)))
+            return waves, textins, bad
         return waves, textins
 
-    def capture_all(scope, target, platform, N=10000, key_len=16):
+    def capture_all(scope, target, platform, N=10000, key_len=16, as_int=False,
+                        chunk_bytes=DEFAULT_CHUNK_BYTES, compressor="default", store=None, defer_verify=False,
+                        resume=False):
         """ Do all three non-specific captures and a Rand_V_Rand capture.
 
-        Stores the results in a CWTVLA standard zarr array
+        Stores the results in a CWTVLA standard trace store, named as in
+        :func:`cwtvla.trace_store.trace_name`. Traces are written to the store a chunk at
+        a time on a background thread as they're captured, so memory use
+        stays bounded and a crash only loses the chunks not yet written. Ciphertexts are stored
+        alongside the traces.
+
+        The number of rows written so far and the key/text sequence used are kept in each
+        traces group's "captured" and "ktp_state" attributes. If a capture is interrupted,
+        calling capture_all again with resume=True keeps the stored arrays and carries on
+        from the last chunk written, with the same keys and plaintexts.
+
+        By default a ValueError is raised as soon as a trace fails verification. With
+        defer_verify=True, ciphertexts are verified in bulk during the capture instead, and the
+        indices of any traces that failed are stored in the traces group's "bad_traces"
+        attribute. :func:`test_cw_non_specific` leaves these out. For Random V Random traces,
+        remove them before analysing, e.g.::
+
+            bad = store.attrs("{platform}/RandVRand-16/traces")["bad_traces"]
+            waves = np.delete(store.read(".../waves"), bad, axis=0)
+            textins = np.delete(store.read(".../textins"), bad, axis=0)
 
         Args:
             scope (CW scope object): Setup scope object
             target (CW target object): Setup target object
-            platform (str): What to call the set in the zarr array
+            platform (str): What to call the set in the store
             N (int): Number of traces to capture
             key_len (int): 16 for AES-128, 32 for AES-256
+            as_int (bool): Store raw integer ADC codes (uint16) instead of float64 traces. The
+                            scale and offset to convert them are stored in the arrays' attrs.
+                            The analysis functions can use these arrays directly.
+            chunk_bytes (int): Target uncompressed size of each stored chunk of traces. Chunks
+                            tile both the trace and sample axes, see :func:`cwtvla.chunking.trace_chunks`
+            compressor: Compressor for the arrays, None for no compression, or "default" for the
+                            store's default compression. Depends on the store: a numcodecs compressor
+                            for zarr, "gzip" or "lzf" for HDF5, see :meth:`cwtvla.trace_store.TraceStore.create`
+            store (TraceStore or str): Store to save the traces in, or a path for
+                            :func:`cwtvla.trace_store.open_trace_store`. If None, uses
+                            :func:`cwtvla.trace_store.default_trace_store` (data/CWData.zarr
+                            unless the CWTVLA_TRACE_STORE environment variable is set)
+            defer_verify (bool): Verify ciphertexts in bulk and record bad traces instead of
+                            raising a ValueError. See :func:`capture_non_specific`
+            resume (bool): Carry on an interrupted capture of platform instead of starting again.
+                            Tests that finished are skipped. N must be the same as the interrupted capture.
         """
         ktps = (FixedVRandomText, SemiFixedVRandomText, FixedVRandomKey)
-        z = zarr.open_group("data/CWData.zarr", mode='a')
-        z_plat = z.create_group("{}".format(platform), overwrite=True)
-        for ktp in ktps:
-            group1 = z_plat.zeros("{}-{}/traces/group1".format(ktp._name, key_len), shape=(N, scope.adc.samples), \
-                chunks=(2500, None), dtype='float64')
-            group2 = z_plat.zeros("{}-{}/traces/group2".format(ktp._name, key_len), shape=(N, scope.adc.samples), \
-                chunks=(2500, None), dtype='float64')
-            group1[:,:], group2[:,:] = capture_non_specific(scope, target, ktp, N, key_len)
+        dtype = _adc_dtype(as_int)
+        scale, offset = adc_scale(scope) if as_int else (1.0, 0.0)
+        samples = scope.adc.samples
+        chunks = trace_chunks((N, samples), dtype, chunk_bytes)
+        store = default_trace_store() if store is None else open_trace_store(store)
+
+        def zeros(test, name, shape, dtype):
+            # every array in a group uses the same rows per chunk, so they're written in step
+            array_chunks = chunks if shape[1] == samples else (chunks[0], shape[1])
+            return store.create(trace_name(platform, test, key_len, name), shape, dtype,
+                                chunks=array_chunks, compressor=compressor)
+
+        def capture_set(test, ktp_class, arrays, capture, verify_stored):
+            # capture one test's arrays, carrying on after the rows already written if resuming
+            group = "{}/{}-{}/traces".format(platform, test, key_len)
+            attrs = store.attrs(group) if resume and group in store else {}
+            ktp = ktp_class(key_len)
+            if "ktp_state" in attrs:
+                targets = [store.open(trace_name(platform, test, key_len, name)) for name, _, _ in arrays]
+                if any(len(target) != N for target in targets):
+                    raise ValueError("Can't resume {} with N={}, it was started with N={}".format(group, N, len(targets[0])))
+                start = attrs.get("captured", 0)
+                if start >= N:
+                    return
+                # the same key/text sequence as the interrupted capture
+                ktp.restore(attrs["ktp_state"])
+                ktp._start_state = ktp.state()
+            else:
+                start = 0
+                targets = [zeros(test, name, shape, dtype) for name, shape, dtype in arrays]
+                for name, shape, _ in arrays:
+                    if shape[1] == samples:
+                        store.set_attrs(trace_name(platform, test, key_len, name), scale=scale, offset=offset)
+                store.set_attrs(group, ktp_state=ktp.state(), captured=0)
+
+            # record how many rows every array has on disk, so an interrupted capture can be resumed
+            written = [start] * len(targets)
+            lock = threading.Lock()
+            def on_write(k, stop):
+                with lock:
+                    written[k] = stop
+                    store.set_attrs(group, captured=min(written))
+
+            # traces are written to disk a chunk at a time while the capture continues
+            writers = [BufferedTraceWriter(target, on_write=functools.partial(on_write, k))
+                        for k, target in enumerate(targets)]
+            try:
+                bad = capture(ktp, writers, start)
+            finally:
+                for writer in writers:
+                    writer.close()
+            if defer_verify and start > 0:
+                # bad traces from before the interruption weren't recorded, so check the stored
+                # ciphertexts against the pairs from the start of the capture
+                ktp.restore(attrs["ktp_state"])
+                old = verify_stored(ktp, targets, start)
+                bad = {name: old[name] + bad[name] for name in bad} if isinstance(bad, dict) else old + bad
+            store.set_attrs(group, captured=N, bad_traces=bad)
+
+        def stored_failures(keys, texts, textouts, start):
+            return np.flatnonzero(~verify_AES_blocks(texts, keys, textouts[:start])).tolist()
+
+        if not resume:
+            store.remove(platform)
+        for ktp_class in ktps:
+            def capture(ktp, writers, start):
+                result = capture_non_specific(scope, target, ktp, N, key_len, writers[0], writers[1], start=start, \
+                    defer_verify=defer_verify, textouts1=writers[2], textouts2=writers[3], as_int=as_int)
+                bad = result[2] if defer_verify else ([], [])
+                return {"group1": bad[0], "group2": bad[1]}
+
+            def verify_stored(ktp, targets, start):
+                return {"group1": stored_failures(*ktp.next_group_A_batch(start), targets[2], start),
+                        "group2": stored_failures(*ktp.next_group_B_batch(start), targets[3], start)}
+
+            capture_set(ktp_class._name, ktp_class,
+                        [("group1", (N, samples), dtype), ("group2", (N, samples), dtype),
+                         ("textouts1", (N, 16), 'uint8'), ("textouts2", (N, 16), 'uint8')],
+                        capture, verify_stored)
 
         # do rand now
-        waves = z_plat.zeros("RandVRand-{}/traces/waves".format(key_len), shape=(N, scope.adc.samples), \
-            chunks=(2500, None), dtype='float64')
-        textins = z_plat.zeros("RandVRand-{}/traces/textins".format(key_len), shape=(N, 16), \
-            chunks=(2500, None), dtype='uint8')
+        def capture(ktp, writers, start):
+            result = capture_rand(scope, target, N, key_len, writers[0], writers[1], start=start, \
+                defer_verify=defer_verify, textouts=writers[2], as_int=as_int, ktp=ktp)
+            return result[2] if defer_verify else []
+
+        def verify_stored(ktp, targets, start):
+            return stored_failures(*ktp.next_group_B_batch(start), targets[2], start)
 
-        waves[:,:], textins[:,:] = capture_rand(scope, target, N, key_len) 
+        capture_set("RandVRand", FixedVRandomText,
+                    [("waves", (N, samples), dtype), ("textins", (N, 16), 'uint8'), ("textouts", (N, 16), 'uint8')],
+                    capture, verify_stored)
 
-    def test_cw_non_specific(platform, key_len=16):
+    def test_cw_non_specific(platform, key_len=16, plot=True, store=None):
         """ Test a platform's non_specific traces
 
+        Traces listed in the "bad_traces" attribute by :func:`capture_all` are left out.
+        The results are also stored in the store under "{platform}/results/NonSpecific-{key_len}"
+        and can be loaded with :code:`TVLAResultSet.load_store()` (or :code:`load_zarr()`
+        for a zarr store) without redoing the t_tests.
+
         Args:
             platform (str): The target object's name
             key_len (int): 16 for AES-128, 32 for AES-256
+            plot (bool): Plot t_test results?
+            store (TraceStore or str): Store the traces were captured to, see :func:`capture_all`
+
+        Returns:
+            TVLAResultSet: Results for each KTP, labelled with the KTP's name
         """
-        import matplotlib.pyplot as plt
+        if plot:
+            import matplotlib.pyplot as plt
+        store = default_trace_store() if store is None else open_trace_store(store)
         ktps = (FixedVRandomText, SemiFixedVRandomText, FixedVRandomKey)
+        results = []
         for ktp in ktps:
-            group = zarr.open_group("data/CWData.zarr/{}/{}-{}".format(platform, ktp._name, key_len))
-            group1 = group.traces.group1
-            group2 = group.traces.group2
-            t = group.zeros("results/tvla", shape=(2, len(group1[0])), dtype='float64', overwrite=True)
-            t[0,:], t[1,:] = t_test(group1[:,:], group2[:,:])
+            group1 = store.open(trace_name(platform, ktp._name, key_len, "group1"))
+            group2 = store.open(trace_name(platform, ktp._name, key_len, "group2"))
+            bad = store.attrs("{}/{}-{}/traces".format(platform, ktp._name, key_len)).get("bad_traces", {})
+            bad = (bad.get("group1", []), bad.get("group2", []))
+            t = t_test(group1, group2, exclude=bad)
+            store.write("{}/{}-{}/results/tvla".format(platform, ktp._name, key_len), t)
             fail_points = check_t_test(t)
             if len(fail_points) > 0:
                 print("Failed at {}".format(fail_points))
             else:
                 print("passed test")
-            plt.figure()
-            plt.plot(t[0])
-            plt.plot(t[1])
-            plt.show()
+            n_traces = (len(group1) - len(set(bad[0])), len(group2) - len(set(bad[1])))
+            results.append(TVLAResult(t, n_traces, label=ktp._name, leakage_model="non-specific"))
+            if plot:
+                plt.figure()
+                plt.plot(t[0])
+                plt.plot(t[1])
+                plt.show()
+
+        results = TVLAResultSet.from_results(results)
+        results.save_store(store, "{}/results/NonSpecific-{}".format(platform, key_len))
+        return results
 
 except Exception as e:
     logging.error("Unable to import chipwhisperer, convenience functions unavailable")
@@ -6,7 +6,12 @@ Copyright (c) 2010,Adam Newman http://www.caller9.com/
 Demur Rumed https://github.com/serprex
 Licensed under the MIT license http://www.opensource.org/licenses/mit-license.php
 
+The functions also accept numpy uint8 arrays of shape (..., 16) (or any shape for the
+sbox functions), which are processed with table lookups and index permutations, so
+leakage models built from them can run on every trace at once.
+
 """
+import numpy as np
 
 _rcon=(
 0x8d,0x01,0x02,0x04,0x08,0x10,0x20,0x40,0x80,0x1b,0x36,0x6c,0xd8,0xab,0x4d,0x9a,
@@ -168,16 +173,28 @@ _gal14=(
 _galI=_gal14,_gal11,_gal13,_gal9
 _galNI=_gal2,_gal3,_gal1,_gal1
 
+#Numpy versions of the tables for array inputs
+_np_sbox=np.array(_sbox, dtype=np.uint8)
+_np_i_sbox=np.array(_i_sbox, dtype=np.uint8)
+_np_galI=np.array(_galI, dtype=np.uint8)
+_np_galNI=np.array(_galNI, dtype=np.uint8)
+
+#state[..., j] comes from state[..., _shiftrows_idx[j]] after shift rows
+_shiftrows_idx=np.array([4*((j//4 + j%4) % 4) + j%4 for j in range(16)])
+_inv_shiftrows_idx=np.array([4*((j//4 - j%4) % 4) + j%4 for j in range(16)])
+
 
 def sbox(inp):
     """Perform an SBox lookup.
 
     Args:
-        inp (int): Byte used for the Sbox lookup.
+        inp (int or numpy.array): Byte used for the Sbox lookup, or a uint8 array of bytes.
 
     Returns:
-        int: The result of the SBox lookup.
+        int: The result of the SBox lookup (an array of the same shape for array input).
     """
+    if isinstance(inp, np.ndarray):
+        return _np_sbox[inp]
     return _sbox[inp]
 
 
@@ -185,11 +202,13 @@ def inv_sbox(inp):
     """Perform an inverse SBox lookup.
 
     Args:
-        inp (int): Byte used for the inverse Sbox lookup.
+        inp (int or numpy.array): Byte used for the inverse Sbox lookup, or a uint8 array of bytes.
 
     Returns:
-        int: The result of the inverse SBox lookup.
+        int: The result of the inverse SBox lookup (an array of the same shape for array input).
     """
+    if isinstance(inp, np.ndarray):
+        return _np_i_sbox[inp]
     return _i_sbox[inp]
 
 
@@ -201,8 +220,10 @@ def subbytes(inp):
 
     Returns:
         list: List of bytes resulting from the multiple
-            SBox lookups.
+            SBox lookups. A new array for array input.
     """
+    if isinstance(inp, np.ndarray):
+        return _np_sbox[inp]
     return [sbox(i) for i in inp]
 
 
@@ -214,8 +235,10 @@ def inv_subbytes(inp):
 
     Returns:
         list: List of bytes resulting from the multiple
-            inverse SBox lookups.
+            inverse SBox lookups. A new array for array input.
     """
+    if isinstance(inp, np.ndarray):
+        return _np_i_sbox[inp]
     return [inv_sbox(i) for i in inp]
 
 
@@ -237,11 +260,13 @@ def shiftrows (state):
     """AES shift rows operation.
 
     Args:
-        state (iterable): Iterable of 16 bytes.
+        state (iterable): Iterable of 16 bytes, or a uint8 array of shape (..., 16).
 
     Returns:
-        list: List of 16 bytes after shift rows operation.
+        list: List of 16 bytes after shift rows operation. A new array for array input.
     """
+    if isinstance(state, np.ndarray):
+        return state[..., _shiftrows_idx]
     #Extract rows as every 4th item starting at [1..3]
     #Replace row with shift_row operation
     for i in 1,2,3:
@@ -253,11 +278,13 @@ def inv_shiftrows (state):
     """Inverse AES shift rows operation.
 
     Args:
-        state (iterable): Iterable of 16 bytes.
+        state (iterable): Iterable of 16 bytes, or a uint8 array of shape (..., 16).
 
     Returns:
-        list: List of 16 bytes after inverse shift rows operation.
+        list: List of 16 bytes after inverse shift rows operation. A new array for array input.
     """
+    if isinstance(state, np.ndarray):
+        return state[..., _inv_shiftrows_idx]
     #Extract rows as every 4th item starting at [1..3]
     #Replace row with inverse shift_row operation
     for i in 1,2,3:
@@ -277,7 +304,22 @@ def _mixcolumn (column, inverse):
             g1[c0]^g2[c1]^g3[c2]^g0[c3])
 
 
+def _np_mixcolumns (state, inverse):
+    # Perform mix_column on every column of a (..., 16) array at once
+    g0,g1,g2,g3=_np_galI if inverse else _np_galNI
+    cols=state.reshape(state.shape[:-1] + (4, 4))
+    c0,c1,c2,c3=cols[...,0],cols[...,1],cols[...,2],cols[...,3]
+    out=np.empty_like(cols)
+    out[...,0]=g0[c0]^g1[c1]^g2[c2]^g3[c3]
+    out[...,1]=g3[c0]^g0[c1]^g1[c2]^g2[c3]
+    out[...,2]=g2[c0]^g3[c1]^g0[c2]^g1[c3]
+    out[...,3]=g1[c0]^g2[c1]^g3[c2]^g0[c3]
+    return out.reshape(state.shape)
+
+
 def _mixcolumns (state, inverse):
+    if isinstance(state, np.ndarray):
+        return _np_mixcolumns(state, inverse)
     # Perform mix_column for each column in the state
     for i, j in (0, 4), (4, 8), (8, 12), (12, 16):
         state[i:j] = _mixcolumn(state[i:j], inverse)
@@ -288,10 +330,10 @@ def mixcolumns(state):
     """AES mix columns operation.
 
     Args:
-        state (iterable): Iterable of 16 bytes.
+        state (iterable): Iterable of 16 bytes, or a uint8 array of shape (..., 16).
 
     Returns:
-        list: List of 16 bytes after mix columns operation.
+        list: List of 16 bytes after mix columns operation. A new array for array input.
     """
     return _mixcolumns(state, False)
 
@@ -300,10 +342,10 @@ def inv_mixcolumns(state):
     """AES inverse mix columns operation.
 
     Args:
-        state (iterable): Iterable of 16 bytes.
+        state (iterable): Iterable of 16 bytes, or a uint8 array of shape (..., 16).
 
     Returns:
-        list: List of 16 bytes after inverse mix columns operation.
+        list: List of 16 bytes after inverse mix columns operation. A new array for array input.
     """
     return _mixcolumns(state, True)
 
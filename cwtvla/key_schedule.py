@@ -29,9 +29,13 @@
 # This file performs forward AND backwards key scheduling. Can work from arbitrary
 # key locations (i.e. first to last, last to first, etc.)
 #
-# Currently only support AES-128 and AES-256
+# Currently only support AES-128 and AES-256, except key_expansion which does the
+# whole forward schedule for AES-128, AES-192 and AES-256, and the *_batch functions
+# which do the same for many keys at once with numpy
 #
 
+import numpy as np
+
 
 def sbox(inp):
     s =  [0x63, 0x7c, 0x77, 0x7b, 0xf2, 0x6b, 0x6f, 0xc5, 0x30, 0x01, 0x67,
@@ -232,3 +236,92 @@ def key_schedule_rounds(input_key, input_round, desired_round):
     #Return answer
     return state
 
+
+
+_sbox_table = [sbox(i) for i in range(256)]
+
+def key_expansion(input_key):
+    """Expand a key into every round key in one pass (FIPS-197 KeyExpansion).
+
+    Args:
+        input_key (list): List of bytes of key, 16/24/32 bytes
+
+    Returns:
+         list: All round keys one after another, (rounds+1)*16 bytes
+    """
+    n = len(input_key)
+    if n not in (16, 24, 32):
+        raise ValueError("Invalid keylength: %d"%n)
+    nk = n // 4
+    total = 4*(nk + 7)
+
+    w = list(input_key)
+    for i in range(nk, total):
+        t = w[-4:]
+        if i % nk == 0:
+            t = [_sbox_table[t[1]] ^ rcon[i // nk], _sbox_table[t[2]], _sbox_table[t[3]], _sbox_table[t[0]]]
+        elif nk > 6 and i % nk == 4:
+            t = [_sbox_table[b] for b in t]
+        j = 4*(i - nk)
+        w += [w[j] ^ t[0], w[j+1] ^ t[1], w[j+2] ^ t[2], w[j+3] ^ t[3]]
+    return w
+
+_np_sbox = np.array(_sbox_table, dtype=np.uint8)
+_np_rcon = np.array(rcon, dtype=np.uint8)
+
+def _schedule_word(w, i, nk):
+    #Word xored with w[i-nk] to get w[i], given w[i-1], for (N, 4) words
+    if i % nk == 0:
+        t = _np_sbox[w[:, [1, 2, 3, 0]]]
+        t[:, 0] ^= _np_rcon[i // nk]
+        return t
+    if nk > 6 and i % nk == 4:
+        return _np_sbox[w]
+    return w
+
+def key_expansion_batch(input_keys):
+    """Expand many keys into their round keys at once.
+
+    Args:
+        input_keys (numpy.array): uint8 array of keys, shape (N, 16/24/32)
+
+    Returns:
+         numpy.array: uint8 array of round keys, shape (N, rounds+1, 16)
+    """
+    input_keys = np.asarray(input_keys, dtype=np.uint8)
+    n = input_keys.shape[1]
+    if n not in (16, 24, 32):
+        raise ValueError("Invalid keylength: %d"%n)
+    nk = n // 4
+    total = 4*(nk + 7)
+
+    w = np.zeros((len(input_keys), total, 4), dtype=np.uint8)
+    w[:, :nk] = input_keys.reshape(-1, nk, 4)
+    for i in range(nk, total):
+        w[:, i] = w[:, i-nk] ^ _schedule_word(w[:, i-1], i, nk)
+    return w.reshape(len(input_keys), -1, 16)
+
+def inverse_key_expansion_batch(final_keys):
+    """Run the key schedule backwards for many keys at once.
+
+    Args:
+        final_keys (numpy.array): uint8 array of the last 16/24/32 bytes of each expanded key,
+            shape (N, 16/24/32). For AES-128 this is the last round key, for AES-256 the
+            last two round keys.
+
+    Returns:
+         numpy.array: uint8 array of round keys, shape (N, rounds+1, 16). Round 0 (and
+         round 1 for AES-256) is the original key.
+    """
+    final_keys = np.asarray(final_keys, dtype=np.uint8)
+    n = final_keys.shape[1]
+    if n not in (16, 24, 32):
+        raise ValueError("Invalid keylength: %d"%n)
+    nk = n // 4
+    total = 4*(nk + 7)
+
+    w = np.zeros((len(final_keys), total, 4), dtype=np.uint8)
+    w[:, total-nk:] = final_keys.reshape(-1, nk, 4)
+    for i in range(total-1, nk-1, -1):
+        w[:, i-nk] = w[:, i] ^ _schedule_word(w[:, i-1], i, nk)
+    return w.reshape(len(final_keys), -1, 16)
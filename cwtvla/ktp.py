@@ -1,8 +1,14 @@
 import warnings
-from .aes_cipher import AESCipher
-from .key_schedule import key_schedule_rounds
+import functools
+from .aes_cipher import TTableAESCipher, BatchKeyAESCipher, _add_round_key_blocks, _mix_columns_blocks, \
+    _i_shift_rows_blocks, _i_sub_bytes_blocks
+from .key_schedule import key_expansion, key_expansion_batch
+from .cache import atomic_write
 import numpy as np
 import random
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 def hexstr2list(data):
     """Convert a string with hex numbers into a list of numbers"""
@@ -30,35 +36,214 @@ def hexStrToByteArray(hexStr):
     ba = bytearray(hexstr2list(hexStr))
     return ba
 
+#: Maximum number of expanded keys kept by _expand_aes_key
+KEY_CACHE_SIZE = 4096
+
+@functools.lru_cache(maxsize=KEY_CACHE_SIZE)
+def _expand_aes_key_cached(key):
+    return tuple(key_expansion(key))
+
 def _expand_aes_key(key):
-    rounds = 0
-    start = 1
-    if len(key) == 16:
-        rounds = 10
-    elif len(key) == 24:
-        rounds = 12
-    elif len(key) == 32:
-        rounds = 14
-        start = 2
-    else:
+    if len(key) not in (16, 24, 32):
         raise ValueError("Invalid AES key length: {}".format(len(key)))
 
-    exp_key = list(key)
-    for i in range(start, rounds+1):
-        exp_key.extend(key_schedule_rounds(list(key), 0, i))
-
-    return exp_key
+    # fixed key runs expand the same key for every trace, so keep recent ones around
+    return list(_expand_aes_key_cached(bytes(key)))
 
 def verify_AES(plaintext, key, ciphertext):
     """ Verifies that AES(plaintext, key) == ciphertext
     """
     key_exp = _expand_aes_key(key)
-    cipher = AESCipher(key_exp)
+    cipher = TTableAESCipher(key_exp)
     calc_ciphertext = bytearray(cipher.cipher_block(list(plaintext)))
     return (ciphertext == calc_ciphertext)
 
+def verify_AES_blocks(plaintexts, keys, ciphertexts):
+    """ Verifies AES(plaintext, key) == ciphertext for many traces at once
 
-class FixedVRandomText:
+    Every trace is encrypted in one batch, with each trace's key schedule also done in a batch.
+
+    Args:
+        plaintexts (array like): Plaintexts, shape (N, 16)
+        keys (array like): Keys, shape (N, key_len), or a single key used for every trace
+        ciphertexts (array like): Ciphertexts to check, shape (N, 16)
+
+    Returns:
+        numpy.array: bool array of shape (N,), True where the ciphertext is correct
+    """
+    plaintexts = np.asarray(plaintexts, dtype=np.uint8).reshape(-1, 16)
+    ciphertexts = np.asarray(ciphertexts, dtype=np.uint8).reshape(-1, 16)
+    keys = np.asarray(keys, dtype=np.uint8)
+    if keys.ndim == 1:
+        cipher = TTableAESCipher(_expand_aes_key(bytearray(keys)))
+    else:
+        cipher = BatchKeyAESCipher(key_expansion_batch(keys))
+    return (cipher.cipher_blocks(plaintexts) == ciphertexts).all(axis=1)
+
+class BulkVerifier:
+    """ Check capture ciphertexts in bulk on a background thread
+
+    Instead of calling :func:`verify_AES` after every trace, traces are added as they're
+    captured and verified a chunk at a time with :func:`verify_AES_blocks` while the
+    capture continues. Traces that fail (or have no ciphertext) are reported by index,
+    so they can be masked out instead of aborting the capture.
+
+    Usage::
+
+        with BulkVerifier() as verifier:
+            for i in range(N):
+                trace = cw.capture_trace(scope, target, text, key)
+                verifier.add(i, text, key, trace.textout)
+        print(verifier.failures) # indices of bad traces
+
+    Args:
+        chunk_len (int): Number of traces to verify at once
+    """
+    def __init__(self, chunk_len=1000):
+        self._chunk_len = chunk_len
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._futures = []
+        self._pending = []
+        self.failures = []
+
+    def add(self, index, text, key, textout):
+        """ Queue a trace for verification
+
+        Args:
+            index (int): Index to report the trace by if it fails
+            text (iterable): Plaintext sent to the target
+            key (iterable): Key sent to the target
+            textout (iterable): Ciphertext returned by the target, or None
+        """
+        self._pending.append((index, bytes(text), bytes(key), None if textout is None else bytes(textout)))
+        if len(self._pending) >= self._chunk_len:
+            self.flush()
+
+    def flush(self):
+        """ Start verifying the queued traces """
+        if self._pending:
+            self._futures.append(self._pool.submit(self._verify, self._pending))
+            self._pending = []
+
+    @staticmethod
+    def _verify(pending):
+        indices = np.array([p[0] for p in pending])
+        valid = np.array([p[3] is not None and len(p[3]) == 16 for p in pending])
+        texts = np.frombuffer(b"".join(p[1] for p in pending), dtype=np.uint8).reshape(-1, 16)
+        keys = np.frombuffer(b"".join(p[2] for p in pending), dtype=np.uint8).reshape(len(pending), -1)
+        textouts = np.frombuffer(b"".join(p[3] if v else bytes(16) for p, v in zip(pending, valid)),
+                                dtype=np.uint8).reshape(-1, 16)
+        ok = verify_AES_blocks(texts, keys, textouts) & valid
+        return indices[~ok].tolist()
+
+    def close(self):
+        """ Wait for all queued traces to be verified
+
+        Returns:
+            list: Sorted indices of the traces that failed verification
+        """
+        self.flush()
+        for future in self._futures:
+            self.failures.extend(future.result())
+        self._futures = []
+        self._pool.shutdown()
+        self.failures.sort()
+        return self.failures
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _cipher_chain(cipher, block, n):
+    """ Encrypt block repeatedly, returning the first n blocks of the chain
+
+    Returns:
+        (n, 16) uint8 array of block, E(block), E(E(block)), ... and the
+        block after the last one as a bytearray
+    """
+    blocks = np.zeros((n, 16), dtype=np.uint8)
+    state = list(block)
+    for i in range(n):
+        blocks[i] = state
+        state = cipher.cipher_block(state)
+    return blocks, bytearray(state)
+
+class _KTP:
+    """ Sequence position handling shared by the key text pair classes
+
+    Subclasses list the attributes holding their sequence state in _state_attrs and
+    the settings that change the sequence in _config_attrs, and count pairs handed
+    out from each group in self._index.
+    """
+    _state_attrs = ()
+    _config_attrs = ("_key_len",)
+
+    def state(self):
+        """ Get the current position in the key/text sequences
+
+        Returns:
+            dict: JSON serializable state, which can be passed to :code:`restore()`
+        """
+        state = {"name": self._name, "index": list(self._index)}
+        for attr in self._config_attrs + self._state_attrs:
+            val = getattr(self, attr)
+            state[attr] = val.hex() if isinstance(val, (bytes, bytearray)) else int(val)
+        return state
+
+    def restore(self, state):
+        """ Go back to a position from :code:`state()`
+
+        Args:
+            state (dict): State from a KTP of the same type and settings
+        """
+        if state["name"] != self._name:
+            raise ValueError("Can't restore {} state into {}".format(state["name"], self._name))
+        for attr in self._config_attrs:
+            if state[attr] != getattr(self, attr):
+                raise ValueError("State has {} {}, expected {}".format(attr, state[attr], getattr(self, attr)))
+        for attr in self._state_attrs:
+            cur = getattr(self, attr)
+            if isinstance(cur, (bytes, bytearray)):
+                setattr(self, attr, bytearray.fromhex(state[attr]))
+            else:
+                setattr(self, attr, type(cur)(state[attr]))
+        self._index = list(state["index"])
+
+    def seek(self, i, checkpoints=None):
+        """ Move both groups so the next pair returned is pair i (0 being the first)
+
+        Chained sequences have to be replayed from the start, or from the latest
+        usable checkpoint if checkpoints are given.
+
+        Args:
+            i (int): Pair to move to
+            checkpoints (list): Optional states from :code:`state()`, such as those
+                                    from :func:`load_checkpoints`
+        """
+        start = self._start_state
+        for checkpoint in checkpoints or []:
+            try:
+                self.restore(checkpoint)
+            except ValueError:
+                continue
+            if max(checkpoint["index"]) <= i and min(checkpoint["index"]) > min(start["index"]):
+                start = checkpoint
+        self.restore(start)
+        self._skip(0, i - self._index[0])
+        self._skip(1, i - self._index[1])
+
+    def _skip(self, group, n):
+        # advance a group by n pairs
+        batch = self.next_group_A_batch if group == 0 else self.next_group_B_batch
+        while n > 0:
+            m = min(n, 10000)
+            batch(m)
+            n -= m
+
+class FixedVRandomText(_KTP):
     """ Key text pairs for FixedVRandomText TVLA
 
     Useful for evaluating the general leakage of a device, but
@@ -72,8 +257,17 @@ class FixedVRandomText:
         key, text ktp.next_group_B() # Random text, fixed key
 
     :code:`next_group_B()` can also be used for Random V Random captures
+
+    The next n pairs can also be generated at once as numpy arrays, for example to
+    plan a whole capture before it starts::
+
+        keys, texts = ktp.next_group_B_batch(10000) # shapes (10000, key_len) and (10000, 16)
+
+    The position in the sequence can be saved with :code:`state()`, restored with :code:`restore()`
+    and moved with :code:`seek()`, e.g. to resume an interrupted capture.
     """
     _name = "FixedVRandomText"
+    _state_attrs = ("_I_0",)
     def __init__(self, key_len=16):
         self._key_len = key_len
         self._I_0 = bytearray([0x00] * 16)
@@ -97,11 +291,14 @@ class FixedVRandomText:
 
         self._K_gen_exp = _expand_aes_key(self._K_gen)
         self._K_dev_exp = _expand_aes_key(self._K_dev)
-        self._cipher = AESCipher(self._K_gen_exp)
-        self._dev_cipher = AESCipher(self._K_dev_exp)
+        self._cipher = TTableAESCipher(self._K_gen_exp)
+        self._dev_cipher = TTableAESCipher(self._K_dev_exp)
+        self._index = [0, 0]
+        self._start_state = self.state()
 
     def next_group_A(self):
         """Return key, text, ciphertext for fixed text group"""
+        self._index[0] += 1
         return self._K_dev, self._I_fixed
 
     def next_group_B(self):
@@ -114,10 +311,25 @@ class FixedVRandomText:
         3rd Call: I2..."""
         pt = self._I_0
         self._I_0 = bytearray(self._cipher.cipher_block(list(self._I_0)))
+        self._index[1] += 1
         return self._K_dev, pt
 
+    def next_group_A_batch(self, n):
+        """Return keys, texts for the next n fixed text group pairs as (n, key_len) and (n, 16) uint8 arrays"""
+        self._index[0] += n
+        return np.tile(np.frombuffer(self._K_dev, dtype=np.uint8), (n, 1)), \
+            np.tile(np.frombuffer(self._I_fixed, dtype=np.uint8), (n, 1))
 
-class FixedVRandomKey:
+    def next_group_B_batch(self, n):
+        """Return keys, texts for the next n random group pairs as (n, key_len) and (n, 16) uint8 arrays
+
+        Same sequence as calling :code:`next_group_B()` n times"""
+        texts, self._I_0 = _cipher_chain(self._cipher, self._I_0, n)
+        self._index[1] += n
+        return np.tile(np.frombuffer(self._K_dev, dtype=np.uint8), (n, 1)), texts
+
+
+class FixedVRandomKey(_KTP):
     """ Key text pairs for FixedVRandomKey TVLA
 
     Usage::
@@ -126,9 +338,11 @@ class FixedVRandomKey:
         ktp = cwtvla.tkp.FixedVRandomKey(key_len=16) #16 byte key - AES128
         key, text ktp.next_group_A() # Random text, fixed key
         key, text ktp.next_group_B() # Random text, Random key
+        keys, texts = ktp.next_group_B_batch(1000) # Next 1000 of each as numpy arrays
 
     """
     _name = "FixedVRandomKey"
+    _state_attrs = ("_I_0_fixed", "_I_0_rand", "_K_0")
     def __init__(self, key_len=16):
         self._key_len = key_len
         self._I_0_fixed = bytearray([0xAA] * 16)
@@ -150,12 +364,15 @@ class FixedVRandomKey:
             raise ValueError("Invalid key length {}, must be 16, 24, or 32".format(key_len))
 
         self._K_gen_exp = _expand_aes_key(self._K_gen)
-        self._cipher = AESCipher(self._K_gen_exp)
+        self._cipher = TTableAESCipher(self._K_gen_exp)
+        self._index = [0, 0]
+        self._start_state = self.state()
 
     def next_group_A(self):
         key = self._K_fixed
         text = self._I_0_fixed
         self._I_0_fixed = bytearray(self._cipher.cipher_block(list(self._I_0_fixed)))
+        self._index[0] += 1
         return key, text
 
     def next_group_B(self):
@@ -170,10 +387,33 @@ class FixedVRandomKey:
 
         text = self._I_0_rand
         self._I_0_rand = bytearray(self._cipher.cipher_block(list(text)))
+        self._index[1] += 1
 
         return key, text
 
-class SemiFixedVRandomText:
+    def next_group_A_batch(self, n):
+        """Return keys, texts for the next n group A pairs as (n, key_len) and (n, 16) uint8 arrays
+
+        Same sequence as calling :code:`next_group_A()` n times"""
+        texts, self._I_0_fixed = _cipher_chain(self._cipher, self._I_0_fixed, n)
+        self._index[0] += n
+        return np.tile(np.frombuffer(self._K_fixed, dtype=np.uint8), (n, 1)), texts
+
+    def next_group_B_batch(self, n):
+        """Return keys, texts for the next n group B pairs as (n, key_len) and (n, 16) uint8 arrays
+
+        Same sequence as calling :code:`next_group_B()` n times"""
+        if self._key_len == 16:
+            keys, self._K_0 = _cipher_chain(self._cipher, self._K_0, n)
+        else:
+            # longer keys use two blocks of the chain each
+            keys, self._K_0 = _cipher_chain(self._cipher, self._K_0, 2*n)
+            keys = keys.reshape(n, 32)[:, :self._key_len]
+        texts, self._I_0_rand = _cipher_chain(self._cipher, self._I_0_rand, n)
+        self._index[1] += n
+        return keys, texts
+
+class SemiFixedVRandomText(_KTP):
     """ Key text pairs for SemiFixedVRandomText.
 
     Sets state in selected round to 0x8B8A490BDF7C00BDD7E6066Cxxxxxxxx. Varies the last bits
@@ -187,9 +427,12 @@ class SemiFixedVRandomText:
         ktp = cwtvla.tkp.SemiFixedVRandomText(key_len=16, round=5) #16 byte key - AES128, reverse from round 5
         key, text ktp.next_group_A() # Semi fixed text, Fixed key
         key, text ktp.next_group_B() # Random text, Fixed key 
+        keys, texts = ktp.next_group_A_batch(1000) # Next 1000 semi fixed texts as numpy arrays
 
     """
     _name = "SemiFixedVRandomText"
+    _state_attrs = ("_I_0", "_I_semi_fixed", "_state_start")
+    _config_attrs = ("_key_len", "_round")
     def __init__(self, key_len=16, round=None):
         self._key_len = key_len
         self._I_0 = bytearray([0x00] * 16)
@@ -220,9 +463,11 @@ class SemiFixedVRandomText:
         self._K_dev_exp = _expand_aes_key(self._K_dev)
         self._K_gen_exp = _expand_aes_key(self._K_gen)
 
-        self._dev_cipher = AESCipher(self._K_dev_exp)
-        self._cipher = AESCipher(self._K_gen_exp)
+        self._dev_cipher = TTableAESCipher(self._K_dev_exp)
+        self._cipher = TTableAESCipher(self._K_gen_exp)
         self._state_start = np.uint32(int.from_bytes(self._I_semi_fixed[:4], "big"))
+        self._index = [0, 0]
+        self._start_state = self.state()
 
     def _invert_from_round(self, plaintext):
         # todo: maybe make round an argument?
@@ -240,6 +485,18 @@ class SemiFixedVRandomText:
         self._dev_cipher._add_round_key(text, 0)
         return bytearray(text)
 
+    def _invert_from_round_blocks(self, states):
+        # same as _invert_from_round, for an (N, 16) array of states at once
+        states = np.array(states, dtype=np.uint8, order='C')
+        for round in range(self._round, 0, -1):
+            _add_round_key_blocks(states, self._dev_cipher._np_round_keys, round)
+            _mix_columns_blocks(states, True)
+            _i_shift_rows_blocks(states)
+            _i_sub_bytes_blocks(states)
+
+        _add_round_key_blocks(states, self._dev_cipher._np_round_keys, 0)
+        return states
+
     def next_group_A(self):
         #update round x state
         with warnings.catch_warnings():
@@ -255,6 +512,7 @@ class SemiFixedVRandomText:
 
         #invert to start of AES
         text = self._invert_from_round(self._I_semi_fixed)
+        self._index[0] += 1
         return self._K_dev, text
 
     def next_group_B(self):
@@ -265,8 +523,182 @@ class SemiFixedVRandomText:
         3rd Call: I2..."""
         pt = self._I_0
         self._I_0 = bytearray(self._cipher.cipher_block(list(self._I_0)))
+        self._index[1] += 1
         return self._K_dev, pt
 
+    def next_group_A_batch(self, n):
+        """Return keys, texts for the next n semi fixed group pairs as (n, key_len) and (n, 16) uint8 arrays
+
+        Same sequence as calling :code:`next_group_A()` n times. The round states for every
+        counter value are built at once and inverted back to plaintexts together."""
+        counters = (int(self._state_start) + 1 + np.arange(n, dtype=np.uint64)) % 2**32
+        states = np.tile(np.frombuffer(self._I_semi_fixed, dtype=np.uint8), (n, 1))
+
+        # counter goes in the last 4 bytes, least significant byte first
+        states[:, 12:] = counters.astype('<u4').view(np.uint8).reshape(n, 4)
+        texts = self._invert_from_round_blocks(states)
+
+        if n > 0:
+            self._state_start = np.uint32(counters[-1])
+            self._I_semi_fixed[12:] = states[-1, 12:].tobytes()
+        self._index[0] += n
+        return np.tile(np.frombuffer(self._K_dev, dtype=np.uint8), (n, 1)), texts
+
+    def next_group_B_batch(self, n):
+        """Return keys, texts for the next n random group pairs as (n, key_len) and (n, 16) uint8 arrays
+
+        Same sequence as calling :code:`next_group_B()` n times"""
+        texts, self._I_0 = _cipher_chain(self._cipher, self._I_0, n)
+        self._index[1] += n
+        return np.tile(np.frombuffer(self._K_dev, dtype=np.uint8), (n, 1)), texts
+
+    def _skip(self, group, n):
+        # group A is counter based, so it can be skipped without generating anything
+        if group == 0 and n > 0:
+            self._state_start = np.uint32((int(self._state_start) + n) % 2**32)
+            self._I_semi_fixed[-4:] = int(self._state_start).to_bytes(4, "little")
+            self._index[0] += n
+            return
+        super()._skip(group, n)
+
+
+_SEQUENCE_GROUPS = ("A", "B")
+
+def _write_sequence_meta(path, meta):
+    with atomic_write(os.path.join(path, "sequence.json"), "w") as f:
+        json.dump(meta, f)
+
+def export_sequence(ktp, path, n, checkpoint_every=10000, resume=False):
+    """ Save the first n key/text pairs of both of a KTP's groups to disk
+
+    The pairs are written to .npy files in the directory path, and the KTP's state is
+    checkpointed every checkpoint_every pairs. An interrupted export can be continued
+    with resume=True. The result can be read with :class:`KTPSequence`, and the
+    checkpoints with :func:`load_checkpoints`.
+
+    Usage::
+
+        ktp = cwtvla.FixedVRandomText()
+        cwtvla.ktp.export_sequence(ktp, "plans/fvr", 100000)
+        seq = cwtvla.ktp.KTPSequence("plans/fvr")
+        seq.seek(50000) # e.g. second capture station takes the second half
+
+    Args:
+        ktp (KTP object): Key text pair object to export. Moved to pair n afterwards.
+        path (str): Directory to write to
+        n (int): Number of pairs to write for each group
+        checkpoint_every (int): Pairs between checkpoints
+        resume (bool): Continue an interrupted export to path from its last checkpoint
+    """
+    os.makedirs(path, exist_ok=True)
+    if resume:
+        with open(os.path.join(path, "sequence.json")) as f:
+            meta = json.load(f)
+        if meta["n"] != n:
+            raise ValueError("Existing sequence has {} pairs, not {}".format(meta["n"], n))
+        ktp.restore(meta["checkpoints"][-1])
+        mode = "r+"
+    else:
+        ktp.seek(0)
+        meta = {"name": ktp._name, "key_len": ktp._key_len, "n": n,
+                "checkpoint_every": checkpoint_every, "checkpoints": [ktp.state()]}
+        _write_sequence_meta(path, meta)
+        mode = "w+"
+
+    arrays = {}
+    for group in _SEQUENCE_GROUPS:
+        arrays["keys_" + group] = np.lib.format.open_memmap(os.path.join(path, "keys_{}.npy".format(group)),
+                                        mode=mode, dtype=np.uint8, shape=(n, ktp._key_len))
+        arrays["texts_" + group] = np.lib.format.open_memmap(os.path.join(path, "texts_{}.npy".format(group)),
+                                        mode=mode, dtype=np.uint8, shape=(n, 16))
+
+    i = ktp._index[0]
+    while i < n:
+        m = min(checkpoint_every, n - i)
+        arrays["keys_A"][i:i+m], arrays["texts_A"][i:i+m] = ktp.next_group_A_batch(m)
+        arrays["keys_B"][i:i+m], arrays["texts_B"][i:i+m] = ktp.next_group_B_batch(m)
+        for arr in arrays.values():
+            arr.flush()
+        i += m
+        meta["checkpoints"].append(ktp.state())
+        _write_sequence_meta(path, meta)
+
+def load_checkpoints(path):
+    """ Load the KTP checkpoints saved by :func:`export_sequence`
+
+    Args:
+        path (str): Directory passed to :func:`export_sequence`
+
+    Returns:
+        list: States that can be passed to a KTP's :code:`restore()` or :code:`seek()`
+    """
+    with open(os.path.join(path, "sequence.json")) as f:
+        return json.load(f)["checkpoints"]
+
+class KTPSequence:
+    """ Key text pairs read from a sequence saved with :func:`export_sequence`
+
+    Has the same methods as the KTP it was exported from, so it can be used in its place,
+    but can seek to any pair without regenerating the sequence.
+
+    Usage::
+
+        import cwtvla
+        ktp = cwtvla.ktp.KTPSequence("plans/fvr")
+        ktp.seek(5000) # resume at pair 5000
+        key, text = ktp.next_group_A()
+
+    Args:
+        path (str): Directory passed to :func:`export_sequence`
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, "sequence.json")) as f:
+            meta = json.load(f)
+        self._name = meta["name"]
+        self._key_len = meta["key_len"]
+        self._n = meta["n"]
+        self._keys = [np.load(os.path.join(path, "keys_{}.npy".format(g)), mmap_mode='r') for g in _SEQUENCE_GROUPS]
+        self._texts = [np.load(os.path.join(path, "texts_{}.npy".format(g)), mmap_mode='r') for g in _SEQUENCE_GROUPS]
+        self._index = [0, 0]
+
+    def __len__(self):
+        return self._n
+
+    def _next_batch(self, group, n):
+        i = self._index[group]
+        if i + n > self._n:
+            raise IndexError("Only {} pairs in sequence".format(self._n))
+        self._index[group] = i + n
+        return np.array(self._keys[group][i:i+n]), np.array(self._texts[group][i:i+n])
+
+    def next_group_A(self):
+        keys, texts = self._next_batch(0, 1)
+        return bytearray(keys[0]), bytearray(texts[0])
+
+    def next_group_B(self):
+        keys, texts = self._next_batch(1, 1)
+        return bytearray(keys[0]), bytearray(texts[0])
+
+    def next_group_A_batch(self, n):
+        return self._next_batch(0, n)
+
+    def next_group_B_batch(self, n):
+        return self._next_batch(1, n)
+
+    def seek(self, i, checkpoints=None):
+        """ Move both groups so the next pair returned is pair i """
+        if not 0 <= i <= self._n:
+            raise IndexError("Only {} pairs in sequence".format(self._n))
+        self._index = [i, i]
+
+    def state(self):
+        return {"name": self._name, "index": list(self._index)}
+
+    def restore(self, state):
+        if state["name"] != self._name:
+            raise ValueError("Can't restore {} state into {}".format(state["name"], self._name))
+        self._index = list(state["index"])
+
 
 if __name__ == "__main__":
     ktp = SemiFixedVRandomText()
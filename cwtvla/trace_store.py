@@ -0,0 +1,494 @@
+"""
+Storage backends for captured traces and analysis results.
+
+A :class:`TraceStore` holds named arrays (e.g. "STM32F3/FixedVRandomText-16/traces/group1")
+and their attributes. The same operations are implemented on top of zarr
+(:class:`ZarrTraceStore`), HDF5 (:class:`HDF5TraceStore`) and plain binary files read with
+np.memmap (:class:`MemmapTraceStore`), so capture and analysis code doesn't depend on the
+file format. Which is fastest depends on the filesystem: uncompressed memmap files are
+usually quickest on a local SSD, while compressed zarr or HDF5 chunks move less data over
+a network filesystem.
+
+:func:`open_trace_store` picks the backend from the path, so switching backends is just a
+matter of using a different path::
+
+    store = cwtvla.open_trace_store("data/CWData.h5")
+    for start, chunk in store.iter_chunks("STM32F3/RandVRand-16/traces/waves"):
+        ...
+
+Arrays returned by :meth:`TraceStore.open` support numpy style row slicing and can be
+passed straight to the analysis functions, which read them a chunk at a time.
+"""
+import json
+import os
+import shutil
+import numpy as np
+from .cache import atomic_write
+from .chunking import DEFAULT_CHUNK_BYTES, DEFAULT_MAX_MEMORY, trace_chunks, default_compressor, iter_chunks
+
+#: Environment variable with the path of the store used by default (see :func:`default_trace_store`)
+TRACE_STORE_ENV = "CWTVLA_TRACE_STORE"
+
+#: Store used by default if TRACE_STORE_ENV isn't set
+DEFAULT_TRACE_STORE = "data/CWData.zarr"
+
+def trace_name(platform, test, key_len, array):
+    """ Standard name of a captured array, e.g. "STM32F3/FixedVRandomText-16/traces/group1"
+
+    Args:
+        platform (str): Name of the capture set
+        test (str): KTP name (e.g. :code:`FixedVRandomText._name`) or "RandVRand"
+        key_len (int): 16 for AES-128, 32 for AES-256
+        array (str): Array name, e.g. "group1", "textouts1", "waves"
+
+    Returns:
+        str
+    """
+    return "{}/{}-{}/traces/{}".format(platform, test, key_len, array)
+
+def _default_chunks(shape, dtype, chunk_bytes):
+    # traces are tiled along both axes, everything else is chunked along rows only
+    if len(shape) == 2 and shape[1] > 16:
+        return trace_chunks(shape, dtype, chunk_bytes)
+    width = int(np.prod(shape[1:], dtype='int64')) or 1
+    return (trace_chunks((shape[0], width), dtype, chunk_bytes)[0],) + tuple(shape[1:])
+
+def _append_chunks(rows, chunk_bytes):
+    # chunks for an array started by append(), sized for the whole array rather than just the first rows
+    chunks = _default_chunks((max(len(rows), 1),) + rows.shape[1:], rows.dtype, chunk_bytes)
+    return (max(chunks[0], chunk_bytes // max(rows[:1].nbytes, 1)),) + chunks[1:]
+
+class TraceStore:
+    """ Named arrays and attributes stored in a file or directory
+
+    Names are "/" separated paths. Attributes can be set on arrays and on any
+    prefix of an array's name (a group). Attribute values must be JSON serializable.
+
+    Subclasses implement :meth:`create`, :meth:`open`, :meth:`append`, :meth:`attrs`,
+    :meth:`set_attrs`, :meth:`remove` and :meth:`__contains__`.
+
+    Args:
+        path (str): Location of the store
+        chunk_bytes (int): Target uncompressed size of each stored chunk of new arrays
+    """
+    def __init__(self, path, chunk_bytes=DEFAULT_CHUNK_BYTES):
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+
+    def create(self, name, shape, dtype, chunks=None, compressor="default"):
+        """ Create a zero filled array, replacing any existing array with the same name
+
+        Args:
+            name (str): Array name
+            shape (tuple): Array shape
+            dtype (numpy.dtype): Array dtype
+            chunks (tuple): Stored chunk shape. If None, picked with :func:`cwtvla.chunking.trace_chunks`
+            compressor: None for no compression, "default" for the backend's default compression,
+                        or a backend specific compressor: a numcodecs compressor for zarr,
+                        "gzip" or "lzf" for HDF5. Ignored by backends that don't compress.
+
+        Returns:
+            array like: The new array, writable with numpy style slicing
+        """
+        raise NotImplementedError
+
+    def open(self, name):
+        """ Open an existing array
+
+        Args:
+            name (str): Array name
+
+        Returns:
+            array like: The array, readable and writable with numpy style slicing
+        """
+        raise NotImplementedError
+
+    def append(self, name, rows):
+        """ Add rows to the end of an array, creating it if it doesn't exist
+
+        Args:
+            name (str): Array name
+            rows (numpy.array): Rows to add. Must match the array's shape apart from the first axis
+        """
+        raise NotImplementedError
+
+    def attrs(self, name=""):
+        """ Attributes of an array or group
+
+        Args:
+            name (str): Array or group name, "" for the whole store
+
+        Returns:
+            dict: Copy of the attributes
+        """
+        raise NotImplementedError
+
+    def set_attrs(self, name="", **attrs):
+        """ Update the attributes of an array or group, creating the group if needed
+
+        Args:
+            name (str): Array or group name, "" for the whole store
+            attrs: Attributes to set
+        """
+        raise NotImplementedError
+
+    def remove(self, name):
+        """ Remove an array, or a group and everything in it. Does nothing if name doesn't exist """
+        raise NotImplementedError
+
+    def __contains__(self, name):
+        raise NotImplementedError
+
+    def close(self):
+        """ Close the underlying file, if there is one """
+
+    def write(self, name, data, compressor="default"):
+        """ Store data as a new array, replacing any existing array with the same name
+
+        Args:
+            name (str): Array name
+            data (numpy.array): Data to store
+            compressor: See :meth:`create`
+
+        Returns:
+            array like: The new array
+        """
+        data = np.asarray(data)
+        array = self.create(name, data.shape, data.dtype, compressor=compressor)
+        array[...] = data
+        return array
+
+    def read(self, name, key=slice(None)):
+        """ Read part of an array into memory
+
+        Args:
+            name (str): Array name
+            key: numpy style index, e.g. :code:`slice(1000, 2000)`. Reads the whole array by default
+
+        Returns:
+            numpy.array
+        """
+        return np.asarray(self.open(name)[key])
+
+    def iter_chunks(self, name, chunk_len=None, max_memory=DEFAULT_MAX_MEMORY, prefetch=True):
+        """ Iterate over an array a chunk of rows at a time
+
+        See :func:`cwtvla.chunking.iter_chunks` for the arguments.
+
+        Yields:
+            (int, numpy.array): Index of the first row of the chunk, and the chunk
+        """
+        return iter_chunks(self.open(name), chunk_len, max_memory, prefetch)
+
+    def _chunks(self, shape, dtype, chunks):
+        if chunks is None:
+            chunks = _default_chunks(shape, dtype, self.chunk_bytes)
+        return chunks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.path)
+
+class ZarrTraceStore(TraceStore):
+    """ Trace store backed by a zarr directory store (e.g. data/CWData.zarr)
+
+    Args:
+        path (str or zarr.Group): Path of the store, or an open zarr group
+        mode (str): zarr open mode
+        chunk_bytes (int): Target uncompressed size of each stored chunk of new arrays
+    """
+    def __init__(self, path, mode='a', chunk_bytes=DEFAULT_CHUNK_BYTES):
+        import zarr
+        if isinstance(path, str):
+            self.root = zarr.open_group(path, mode=mode)
+        else:
+            self.root = path
+            path = getattr(getattr(path, "store", None), "path", None)
+        super().__init__(path, chunk_bytes)
+
+    def create(self, name, shape, dtype, chunks=None, compressor="default"):
+        chunks = self._chunks(shape, dtype, chunks)
+        comp = default_compressor(dtype) if compressor == "default" else compressor
+        return self.root.zeros(name, shape=shape, chunks=chunks, dtype=dtype, compressor=comp, overwrite=True)
+
+    def open(self, name):
+        return self.root[name]
+
+    def append(self, name, rows):
+        rows = np.asarray(rows)
+        if name not in self:
+            # chunk for the expected size of the array, not just the first rows
+            self.create(name, (0,) + rows.shape[1:], rows.dtype, chunks=_append_chunks(rows, self.chunk_bytes))
+        self.root[name].append(rows)
+
+    def attrs(self, name=""):
+        node = self.root[name] if name else self.root
+        return node.attrs.asdict()
+
+    def set_attrs(self, name="", **attrs):
+        if not name:
+            node = self.root
+        elif name in self.root:
+            node = self.root[name]
+        else:
+            node = self.root.require_group(name)
+        node.attrs.update(attrs)
+
+    def remove(self, name):
+        if name in self.root:
+            del self.root[name]
+
+    def __contains__(self, name):
+        return name in self.root
+
+    def group(self, name):
+        """ The zarr group for name, created if it doesn't exist """
+        return self.root.require_group(name)
+
+class HDF5TraceStore(TraceStore):
+    """ Trace store backed by an HDF5 file. Needs h5py.
+
+    Arrays are chunked HDF5 datasets that can be resized along the first axis. HDF5 can't use
+    numcodecs compressors, so compressor must be one of the filters built into h5py: "gzip",
+    "lzf", or None for no compression. "default" uses gzip.
+    Attributes that aren't numbers or strings are stored as JSON.
+
+    Args:
+        path (str): Path of the .h5 file
+        mode (str): h5py open mode
+        chunk_bytes (int): Target uncompressed size of each stored chunk of new arrays
+    """
+    _JSON_PREFIX = "json:"
+    _COMPRESSORS = {"default": "gzip", "gzip": "gzip", "lzf": "lzf", None: None}
+
+    def __init__(self, path, mode='a', chunk_bytes=DEFAULT_CHUNK_BYTES):
+        import h5py
+        super().__init__(path, chunk_bytes)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = h5py.File(path, mode)
+
+    def create(self, name, shape, dtype, chunks=None, compressor="default"):
+        import h5py
+        compression = self._compression(compressor)
+        self.remove(name)
+        dtype = np.dtype(dtype)
+        if dtype.kind == 'U':
+            dtype = h5py.string_dtype()
+        if not len(shape):
+            return self.file.create_dataset(name, shape=shape, dtype=dtype)
+        return self.file.create_dataset(name, shape=shape, dtype=dtype, chunks=self._chunks(shape, dtype, chunks),
+                                        maxshape=(None,) + tuple(shape[1:]), compression=compression)
+
+    def _compression(self, compressor):
+        # h5py filter for compressor
+        if not isinstance(compressor, (str, type(None))) or compressor not in self._COMPRESSORS:
+            raise ValueError("Invalid HDF5 compressor {!r}, must be one of {}".format(
+                                compressor, list(self._COMPRESSORS)))
+        return self._COMPRESSORS[compressor]
+
+    def open(self, name):
+        return self.file[name]
+
+    def read(self, name, key=slice(None)):
+        dataset = self.file[name]
+        if dataset.dtype.kind == 'O':
+            # variable length strings, stored for str arrays
+            return np.array(dataset.asstr()[key], dtype='U')
+        return np.asarray(dataset[key])
+
+    def write(self, name, data, compressor="default"):
+        data = np.asarray(data)
+        array = self.create(name, data.shape, data.dtype, compressor=compressor)
+        array[...] = data.astype(object) if data.dtype.kind == 'U' else data
+        return array
+
+    def append(self, name, rows):
+        rows = np.asarray(rows)
+        if name not in self:
+            self.create(name, (0,) + rows.shape[1:], rows.dtype, chunks=_append_chunks(rows, self.chunk_bytes))
+        dataset = self.file[name]
+        start = len(dataset)
+        dataset.resize(start + len(rows), axis=0)
+        dataset[start:] = rows
+
+    def attrs(self, name=""):
+        node = self.file[name] if name else self.file
+        attrs = {}
+        for key, value in node.attrs.items():
+            if isinstance(value, bytes):
+                value = value.decode()
+            if isinstance(value, str) and value.startswith(self._JSON_PREFIX):
+                value = json.loads(value[len(self._JSON_PREFIX):])
+            elif isinstance(value, np.generic):
+                value = value.item()
+            attrs[key] = value
+        return attrs
+
+    def set_attrs(self, name="", **attrs):
+        if not name:
+            node = self.file
+        elif name in self.file:
+            node = self.file[name]
+        else:
+            node = self.file.require_group(name)
+        for key, value in attrs.items():
+            if not isinstance(value, (int, float, str)):
+                value = self._JSON_PREFIX + json.dumps(value)
+            node.attrs[key] = value
+
+    def remove(self, name):
+        if name in self.file:
+            del self.file[name]
+
+    def __contains__(self, name):
+        return name in self.file
+
+    def close(self):
+        self.file.close()
+
+class MemmapTraceStore(TraceStore):
+    """ Trace store of plain binary files, read and written with np.memmap
+
+    Each array is a raw C order file "<name>.dat" with its dtype, shape and attributes
+    in "<name>.json". Groups are directories, with their attributes in ".attrs.json".
+    There's no compression or chunking, so reads and writes go straight to the page cache.
+    Appending writes to the end of the .dat file.
+
+    Args:
+        path (str): Directory of the store. Created if it doesn't exist.
+        mode (str): "r" to open arrays read only, "a" (or anything else) for read/write
+        chunk_bytes (int): Unused, kept for the same signature as the other backends
+    """
+    def __init__(self, path, mode='a', chunk_bytes=DEFAULT_CHUNK_BYTES):
+        super().__init__(path, chunk_bytes)
+        self.mode = mode
+        if mode != 'r':
+            os.makedirs(path, exist_ok=True)
+
+    def _file(self, name, ext):
+        return os.path.join(self.path, *name.strip("/").split("/")) + ext
+
+    def _meta_file(self, name):
+        if name and os.path.exists(self._file(name, ".json")):
+            return self._file(name, ".json")
+        return os.path.join(self.path, *[p for p in name.strip("/").split("/") if p], ".attrs.json")
+
+    def _load_json(self, filename):
+        try:
+            with open(filename) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_json(self, filename, meta):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with atomic_write(filename, "w") as f:
+            json.dump(meta, f)
+
+    def _meta(self, name):
+        meta = self._load_json(self._file(name, ".json"))
+        if not meta:
+            raise KeyError(name)
+        return meta
+
+    def create(self, name, shape, dtype, chunks=None, compressor="default"):
+        self.remove(name)
+        shape = tuple(int(s) for s in shape)
+        dtype = np.dtype(dtype)
+        filename = self._file(name, ".dat")
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "wb") as f:
+            f.truncate(int(np.prod(shape, dtype='int64')) * dtype.itemsize)
+        self._save_json(self._file(name, ".json"), {"dtype": dtype.str, "shape": list(shape), "attrs": {}})
+        return self.open(name)
+
+    def open(self, name):
+        meta = self._meta(name)
+        shape = tuple(meta["shape"])
+        dtype = np.dtype(meta["dtype"])
+        mode = 'r' if self.mode == 'r' else 'r+'
+        if 0 in shape:
+            # np.memmap can't map an empty file
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self._file(name, ".dat"), dtype=dtype, mode=mode, shape=shape)
+
+    def append(self, name, rows):
+        rows = np.ascontiguousarray(rows)
+        if name not in self:
+            self.create(name, (0,) + rows.shape[1:], rows.dtype)
+        meta = self._meta(name)
+        if tuple(meta["shape"][1:]) != rows.shape[1:]:
+            raise ValueError("Can't append rows of shape {} to array of shape {}".format(rows.shape, tuple(meta["shape"])))
+        with open(self._file(name, ".dat"), "ab") as f:
+            f.write(rows.astype(meta["dtype"], copy=False).tobytes())
+        meta["shape"][0] += len(rows)
+        self._save_json(self._file(name, ".json"), meta)
+
+    def attrs(self, name=""):
+        meta = self._load_json(self._meta_file(name))
+        return dict(meta.get("attrs", {}))
+
+    def set_attrs(self, name="", **attrs):
+        filename = self._meta_file(name)
+        meta = self._load_json(filename)
+        meta.setdefault("attrs", {}).update(attrs)
+        self._save_json(filename, meta)
+
+    def remove(self, name):
+        group = self._file(name, "")
+        if name.strip("/") and os.path.isdir(group):
+            shutil.rmtree(group)
+        for ext in (".dat", ".json"):
+            if os.path.exists(self._file(name, ext)):
+                os.remove(self._file(name, ext))
+
+    def __contains__(self, name):
+        return os.path.exists(self._file(name, ".json")) or os.path.isdir(self._file(name, ""))
+
+#: Backends available to :func:`open_trace_store`
+TRACE_STORES = {
+    "zarr": ZarrTraceStore,
+    "hdf5": HDF5TraceStore,
+    "memmap": MemmapTraceStore,
+}
+
+def open_trace_store(path, backend=None, mode='a', chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """ Open a trace store, picking the backend from the path
+
+    Paths ending in .zarr use zarr, .h5 or .hdf5 use HDF5, anything else is a
+    :class:`MemmapTraceStore` directory. Passing a :class:`TraceStore` returns it unchanged.
+
+    Args:
+        path (str or TraceStore): Path of the store
+        backend (str): "zarr", "hdf5" or "memmap" to override the backend picked from path
+        mode (str): Open mode, "r" for read only or "a" for read/write
+        chunk_bytes (int): Target uncompressed size of each stored chunk of new arrays
+
+    Returns:
+        TraceStore
+    """
+    if isinstance(path, TraceStore):
+        return path
+    if backend is None:
+        ext = os.path.splitext(path.rstrip("/"))[1].lower()
+        backend = {".zarr": "zarr", ".h5": "hdf5", ".hdf5": "hdf5"}.get(ext, "memmap")
+    if backend not in TRACE_STORES:
+        raise ValueError("Invalid backend {}, must be one of {}".format(backend, list(TRACE_STORES)))
+    return TRACE_STORES[backend](path, mode=mode, chunk_bytes=chunk_bytes)
+
+def default_trace_store(mode='a'):
+    """ Open the store named by the CWTVLA_TRACE_STORE environment variable, or data/CWData.zarr
+
+    Lets the backend be picked per machine (e.g. a memmap directory on a local SSD,
+    zarr on a network filesystem) without changing any code.
+
+    Returns:
+        TraceStore
+    """
+    return open_trace_store(os.environ.get(TRACE_STORE_ENV, DEFAULT_TRACE_STORE), mode=mode)
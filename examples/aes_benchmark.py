@@ -0,0 +1,31 @@
+# compare the per block speed of the AES engines used for key/text generation
+import timeit
+import numpy as np
+from cwtvla.aes_cipher import AESCipher, TTableAESCipher
+from cwtvla.ktp import _expand_aes_key
+
+N = 20000
+
+for key_len in (16, 32):
+    key_exp = _expand_aes_key(bytearray(range(key_len)))
+    block = list(range(16))
+
+    ciphers = {"AESCipher": AESCipher(key_exp), "TTableAESCipher": TTableAESCipher(key_exp)}
+    assert ciphers["AESCipher"].cipher_block(block) == ciphers["TTableAESCipher"].cipher_block(block)
+
+    print("AES-{}:".format(key_len*8))
+    base = None
+    for name, cipher in ciphers.items():
+        t = timeit.timeit(lambda: cipher.cipher_block(block), number=N) / N
+        base = base or t
+        print("  {:<16} {:6.2f} us/block ({:.1f}x)".format(name, t*1E6, base/t))
+
+    # bytes in, bytes out skips the list conversions
+    cipher = ciphers["TTableAESCipher"]
+    t = timeit.timeit(lambda: cipher.cipher_block(bytes(block)), number=N) / N
+    print("  {:<16} {:6.2f} us/block ({:.1f}x)".format("TTable (bytes)", t*1E6, base/t))
+
+    # batched numpy path, for comparison
+    blocks = np.tile(np.array(block, dtype=np.uint8), (N, 1))
+    t = timeit.timeit(lambda: ciphers["AESCipher"].cipher_blocks(blocks), number=1) / N
+    print("  {:<16} {:6.2f} us/block ({:.1f}x)".format("cipher_blocks", t*1E6, base/t))
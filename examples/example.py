@@ -10,13 +10,16 @@ scope.default_setup()
 # capture traces...
 N = 50000 #total traces = 2*n
 
-from cwtvla.ktp import FixedVRandomText, verify_AES
+from cwtvla.ktp import FixedVRandomText, BulkVerifier
 import numpy as np
 key_len = 16
 ktp = FixedVRandomText(key_len)
 
 group1 = np.zeros((N, scope.adc.samples), dtype='float64')
 group2 = np.zeros((N, scope.adc.samples), dtype='float64')
+
+# check the ciphertexts in bulk in the background instead of after every trace
+verify1, verify2 = BulkVerifier(), BulkVerifier()
 for i in trange(N):
     key, text = ktp.next_group_A()
 
@@ -24,8 +27,7 @@ for i in trange(N):
     while trace is None:
         trace = cw.capture_trace(scope, target, text, key)
 
-    if not verify_AES(text, key, trace.textout):
-        raise ValueError("Encryption failed")
+    verify1.add(i, text, key, trace.textout)
     group1[i,:] = trace.wave[:]
 
     key, text = ktp.next_group_B() 
@@ -34,8 +36,14 @@ for i in trange(N):
         trace = cw.capture_trace(scope, target, text, key)
 
     group2[i,:] = trace.wave[:]
-    if not verify_AES(text, key, trace.textout):
-        raise ValueError("Encryption failed")
+    verify2.add(i, text, key, trace.textout)
+
+# drop any traces where the encryption failed
+bad1, bad2 = verify1.close(), verify2.close()
+if bad1 or bad2:
+    print("Encryption failed for {} traces".format(len(bad1) + len(bad2)))
+    group1 = np.delete(group1, bad1, axis=0)
+    group2 = np.delete(group2, bad2, axis=0)
 
 # do analysis
 from cwtvla.analysis import t_test, check_t_test
@@ -0,0 +1,18 @@
+# rechunk a zarr trace store (e.g. data/CWData.zarr) out of core into the
+# tiled, compressed layout used for new captures
+import argparse
+from cwtvla import chunking
+
+parser = argparse.ArgumentParser(description="Rechunk a zarr trace store out of core")
+parser.add_argument("source", help="zarr store to read, e.g. data/CWData.zarr")
+parser.add_argument("dest", help="zarr store to write")
+parser.add_argument("--chunk-mb", type=float, default=chunking.DEFAULT_CHUNK_BYTES / 1024**2,
+                    help="target uncompressed chunk size in MiB")
+parser.add_argument("--max-samples", type=int, default=chunking.DEFAULT_MAX_CHUNK_SAMPLES,
+                    help="maximum chunk width along the sample axis")
+parser.add_argument("--no-compression", action="store_true", help="store chunks uncompressed")
+parser.add_argument("--max-memory-mb", type=float, default=chunking.DEFAULT_MAX_MEMORY / 1024**2,
+                    help="memory budget in MiB")
+args = parser.parse_args()
+chunking.rechunk_zarr(args.source, args.dest, int(args.chunk_mb * 1024**2), args.max_samples,
+                       None if args.no_compression else "default", int(args.max_memory_mb * 1024**2))
@@ -122,8 +122,9 @@ if __name__ == "__main__":
     hp.setrelheap()
     z = zarr.open("SFvR/STM32F4-SemiFixedVRandomText-5000-16.zarr")
     print(z.tree())
-    group1 = z.traces.group1[:,:]
-    group2 = z.traces.group2[:,:]
+    # zarr arrays are read a chunk at a time, no need to load them into memory first
+    group1 = z.traces.group1
+    group2 = z.traces.group2
     print(hp.heap())
     t = analysis.t_test(group1, group2)
     import matplotlib.pyplot as plt
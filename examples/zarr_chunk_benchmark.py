@@ -0,0 +1,57 @@
+# compare zarr chunk layouts and compression for trace arrays
+#
+# usage: python zarr_chunk_benchmark.py [N] [samples]
+import sys
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+import zarr
+from cwtvla.analysis import t_test
+from cwtvla.chunking import trace_chunks, default_compressor, BufferedTraceWriter
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+samples = int(sys.argv[2]) if len(sys.argv) > 2 else 24400
+
+# 10 bit ADC style traces: a fixed waveform plus noise, quantized
+rng = np.random.default_rng(0)
+base = np.sin(np.linspace(0, 200, samples)) * 100 + 512
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+for dtype in ('float64', 'uint16'):
+    layouts = {
+        "rows=2500, raw": ((min(N, 2500), None), None),
+        "tiled, raw": (trace_chunks((N, samples), dtype), None),
+        "tiled, blosc": (trace_chunks((N, samples), dtype), default_compressor(dtype)),
+    }
+    print("{} traces of {} samples, {}".format(N, samples, dtype))
+    for name, (chunks, compressor) in layouts.items():
+        path = tempfile.mkdtemp()
+        try:
+            z = zarr.open_group(path, mode='w')
+            groups = [z.zeros(g, shape=(N, samples), chunks=chunks, dtype=dtype, compressor=compressor)
+                      for g in ("group1", "group2")]
+
+            t0 = time.time()
+            for group in groups:
+                with BufferedTraceWriter(group) as writer:
+                    for i in range(N):
+                        trace = base + rng.normal(0, 4, samples)
+                        writer[i] = trace if dtype == 'float64' else np.round(trace)
+            write = time.time() - t0
+
+            t0 = time.time()
+            t_test(groups[0], groups[1])
+            full = time.time() - t0
+
+            t0 = time.time()
+            groups[0][:, 1000:1500]
+            window = time.time() - t0
+
+            print("  {:<16} chunks={!s:<14} size={:7.1f} MB write={:6.2f}s t_test={:6.2f}s window={:6.3f}s".format(
+                name, groups[0].chunks, dir_size(path) / 1024**2, write, full, window))
+        finally:
+            shutil.rmtree(path)